@@ -0,0 +1,259 @@
+"""Benchmarks for the hot paths of blocksim and tbcontrol
+
+Run all the benchmarks and write the results to a JSON file with
+
+    python benchmarks/benchmarks.py --output results.json
+
+Only run the benchmarks whose names contain a string with --filter, and
+compare with the results of another commit with --compare, which reports
+the ratio of the times and exits with status 1 if any benchmark is slower
+than --threshold times the old time:
+
+    python benchmarks/benchmarks.py --filter tanks --compare old.json
+
+Each benchmark is called `number` times per repeat, with number chosen so
+that a repeat takes at least --min-time seconds, and the per call times of
+the repeats are summarised. The minimum is the most stable figure to compare
+between commits on the same machine.
+
+The JSON output has the form
+
+    {"schema": 1,
+     "environment": {"python": ..., "numpy": ..., "platform": ..., ...},
+     "benchmarks": {"<name>": {"group": ..., "parameters": {...}, "number": ..., "repeat": ...,
+                               "min": ..., "median": ..., "mean": ..., "stdev": ...}}}
+
+with times in seconds and keys sorted, so files can be diffed directly.
+"""
+
+import argparse
+import itertools
+import json
+import pathlib
+import platform
+import statistics
+import subprocess
+import sys
+import timeit
+
+import numpy
+import scipy
+import sympy
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+from tbcontrol import blocksim, responses, symbolic
+from tbcontrol.numeric import skogestad_half
+
+SCHEMA = 1
+
+# name: (group, parameters, setup) where setup(**parameters) returns the function to time
+BENCHMARKS = {}
+
+
+def benchmark(group, where=None, **values):
+    """Register a benchmark setup function for every combination of the parameter values
+
+    Only the combinations for which where(**parameters) is true are registered, if it is given.
+    """
+    def register(setup):
+        for combination in itertools.product(*values.values()):
+            parameters = dict(zip(values, combination))
+            if where is not None and not where(**parameters):
+                continue
+            label = ','.join(f'{name}={value}' for name, value in parameters.items())
+            name = f'{group}.{setup.__name__}' + (f'[{label}]' if label else '')
+            BENCHMARKS[name] = (group, parameters, setup)
+        return setup
+    return register
+
+
+ts = numpy.linspace(0, 100, 1001)
+
+
+@benchmark('blocksim', mode=['interpreted', 'compiled', 'generated', 'zoh', 'adaptive'])
+def closed_loop(mode):
+    """simple_control_diagram with a PI controller and a FOPDT plant"""
+    diagram = blocksim.simple_control_diagram(blocksim.PI('Gc', 'e', 'u', 1, 10),
+                                              blocksim.LTI('G', 'u', 'yu', 1, [10, 1], 2))
+    options = {'interpreted': {}, 'compiled': {'compiled': True},
+               'generated': {'compiled': 'generated'}, 'zoh': {'compiled': True, 'method': 'zoh'},
+               'adaptive': {'method': 'adaptive'}}[mode]
+    return lambda: diagram.simulate(ts, **options)
+
+
+@benchmark('blocksim', parameters=[1, 3])
+def sensitivity(parameters):
+    """Forward sensitivities of a PID loop with a FOPDT plant with respect to some of the PID parameters"""
+    diagram = blocksim.simple_control_diagram(blocksim.PID('Gc', 'e', 'u', 1, 10, 1),
+                                              blocksim.LTI('G', 'u', 'yu', 1, [10, 1], 2))
+    names = [('Gc', name) for name in ['Kc', 'tau_i', 'tau_d'][:parameters]]
+    return lambda: diagram.simulate_sensitivity(ts, names)
+
+
+# Delayed tanks are never solved in closed form, which would just repeat compiled=False
+@benchmark('blocksim', N=[1, 5, 20, 60, 200], deadtime=[False, True], compiled=[False, True, 'closed_form'],
+           where=lambda N, deadtime, compiled: not (deadtime and compiled == 'closed_form'))
+def tanks(N, deadtime, compiled):
+    """N first order tanks in series, optionally with a Deadtime block after every tank
+
+    Without deadtime the tanks are linear, so 'closed_form' solves them in
+    closed form, while the others step through the times.
+    """
+    blocks = []
+    for i in range(N):
+        if deadtime:
+            blocks.append(blocksim.LTI(f'G{i}', f'h{i}', f'q{i}', 1, [1, 1]))
+            blocks.append(blocksim.Deadtime(f'D{i}', f'q{i}', f'h{i + 1}', 0.5))
+        else:
+            blocks.append(blocksim.LTI(f'G{i}', f'h{i}', f'h{i + 1}', 1, [1, 1]))
+    diagram = blocksim.Diagram(blocks, {}, {'h0': blocksim.step()})
+    closed_form = compiled == 'closed_form'
+    return lambda: diagram.simulate(ts, compiled=compiled is True, closed_form=closed_form)
+
+
+@benchmark('blocksim', compiled=[False, True])
+def discrete_loop(compiled):
+    """Discrete PI controller with a sample time of 1 controlling a SOPDT plant simulated with dt=0.1"""
+    Gc = blocksim.DiscreteTF('Gc', 'e', 'u', 1, [0.5, -0.4], [1, -1])
+    G = blocksim.LTI('G', 'u', 'yu', 1, [15, 8, 1], 1)
+    diagram = blocksim.simple_control_diagram(Gc, G, ysp=blocksim.step(starttime=5))
+    return lambda: diagram.simulate(ts, compiled=compiled)
+
+
+@benchmark('blocksim', closed_form=[False, True])
+def sampled_loop(closed_form):
+    """Discrete PI controller with a sample time of 1 controlling a SOPDT plant without delay simulated with dt=0.01
+
+    With closed_form the plant is solved at once between the samples.
+    """
+    Gc = blocksim.DiscreteTF('Gc', 'e', 'u', 1, [0.5, -0.4], [1, -1])
+    G = blocksim.LTI('G', 'u', 'yu', 1, [15, 8, 1])
+    diagram = blocksim.simple_control_diagram(Gc, G, ysp=blocksim.step(starttime=5))
+    fine = numpy.linspace(0, 100, 10001)
+    return lambda: diagram.simulate(fine, compiled=True, closed_form=closed_form)
+
+
+@benchmark('responses', n=[10_000, 1_000_000])
+def fopdt(n):
+    t = numpy.linspace(0, 100, n)
+    return lambda: responses.fopdt(t, 2, 10, 3)
+
+
+@benchmark('responses', n=[10_000, 1_000_000], zeta=[0.5, 1, 2])
+def sopdt(n, zeta):
+    t = numpy.linspace(0, 100, n)
+    return lambda: responses.sopdt(t, 2, 10, zeta, 3)
+
+
+@benchmark('symbolic', order=[3, 5, 7])
+def routh(order):
+    """Routh array of (s + 1)**order + K, which needs symbolic simplification"""
+    s, K = sympy.symbols('s, K')
+    p = sympy.Poly((s + 1)**order + K, s)
+    return lambda: symbolic.routh(p)
+
+
+@benchmark('numeric', order=[1, 2])
+def skogestad(order):
+    num_timeconstants = [-0.3, 0.08]
+    den_timeconstants = [2, 1, 0.4, 0.2, 0.05, 0.05, 0.05]
+    return lambda: skogestad_half(num_timeconstants, den_timeconstants, delay=0, order=order)
+
+
+def environment():
+    """Description of the machine and versions the benchmarks were run with"""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=pathlib.Path(__file__).parent).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {'commit': commit,
+            'machine': platform.machine(),
+            'numpy': numpy.__version__,
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'python': platform.python_version(),
+            'scipy': scipy.__version__,
+            'sympy': sympy.__version__}
+
+
+def measure(function, repeat, min_time):
+    """Per call times of function for each repeat"""
+    timer = timeit.Timer(function)
+    number = 1
+    while True:
+        elapsed = timer.timeit(number)
+        if elapsed >= min_time:
+            break
+        number *= 2 if elapsed == 0 else max(2, int(min_time/elapsed) + 1)
+    times = [elapsed] + timer.repeat(repeat - 1, number)
+    return number, [t/number for t in times]
+
+
+def run(names, repeat=5, min_time=0.2, log=None):
+    """Run the named benchmarks and return the results in the JSON format"""
+    results = {}
+    for name in names:
+        group, parameters, setup = BENCHMARKS[name]
+        number, times = measure(setup(**parameters), repeat, min_time)
+        results[name] = {'group': group,
+                         'parameters': parameters,
+                         'number': number,
+                         'repeat': repeat,
+                         'min': min(times),
+                         'median': statistics.median(times),
+                         'mean': statistics.mean(times),
+                         'stdev': statistics.stdev(times) if len(times) > 1 else 0.0}
+        if log:
+            print(f"{name:<60} {1e3*min(times):12.4f} ms", file=log)
+    return {'schema': SCHEMA, 'environment': environment(), 'benchmarks': results}
+
+
+def compare(old, new, threshold):
+    """Print the ratio of new to old minimum times and return the names of benchmarks slower than threshold"""
+    slower = []
+    for name, result in new['benchmarks'].items():
+        if name not in old['benchmarks']:
+            continue
+        ratio = result['min']/old['benchmarks'][name]['min']
+        flag = ''
+        if ratio > threshold:
+            slower.append(name)
+            flag = '  SLOWER'
+        print(f"{name:<60} {ratio:8.2f}{flag}")
+    return slower
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--output', '-o', help='JSON file to write the results to')
+    parser.add_argument('--filter', '-k', default='', help='only run benchmarks with names containing this string')
+    parser.add_argument('--repeat', type=int, default=5, help='number of repeats of each benchmark')
+    parser.add_argument('--min-time', type=float, default=0.2, help='minimum time in seconds for each repeat')
+    parser.add_argument('--compare', help='JSON file with results to compare with')
+    parser.add_argument('--threshold', type=float, default=1.2,
+                        help='ratio of times above which a benchmark counts as slower')
+    parser.add_argument('--list', action='store_true', help='list the benchmarks and exit')
+    args = parser.parse_args(arguments)
+
+    names = [name for name in BENCHMARKS if args.filter in name]
+    if args.list:
+        print('\n'.join(names))
+        return 0
+
+    results = run(names, args.repeat, args.min_time, log=sys.stdout)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write('\n')
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        if compare(old, results, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,9 +1,63 @@
-from collections import defaultdict
+from collections.abc import Mapping
+import bisect
+import contextlib
+import copy
+import functools
+import hashlib
+import json
+import os
+import time
+import tracemalloc
 import scipy
+import scipy.integrate
+import scipy.linalg
+import scipy.optimize
 import scipy.signal
+import scipy.sparse
 import numpy
 
+from .signals import (SAMPLE_TOLERANCE, InputSignal, Constant, Step, Ramp, PulseTrain, PRBS,
+                      PiecewiseLinear, step, zero)
+from .metrics import Metric, IAE, ITAE, ISE, MaxDeviation, Overshoot, SettlingTime, DEFAULT_METRICS
+from .sweep import sweep
+
+METHODS = ('euler', 'zoh', 'adaptive')
+
+# Compiled diagrams only store the rows of their matrices which change z (see
+# RowUpdate). These rows, the derivatives of the matrices and the augmented
+# matrices of SensitivityDiagram are stored as scipy.sparse arrays if they have
+# at least SPARSE_SIZE**2 elements, of which at most a fraction SPARSE_FILL is
+# nonzero. Below that size the dense products are faster.
+SPARSE_SIZE = 250
+SPARSE_FILL = 0.05
+
+# Diagrams which are solved in closed form (see CompiledDiagram.solve) are
+# solved for at most CHUNK_SIZE timesteps at a time, so the memory used does
+# not grow with the length of the simulation beyond the recorded signals.
+CHUNK_SIZE = 10000
+
+
 class Block:
+    # Blocks only store the attributes listed in their slots, which keeps
+    # them small and their attribute access fast. Subclasses which do not
+    # declare __slots__ get a __dict__ as usual.
+    __slots__ = ('name', 'inputname', 'outputname')
+
+    # True if the output depends on the current input, used to order the
+    # evaluation of the diagram. Blocks which only depend on their state
+    # should set this to False.
+    feedthrough = True
+
+    # Sample time of blocks which only change at the sample instants
+    # k*sample_time. These must also provide next_sample, the time of the next
+    # sample instant, and only need change_input to be called at or after it
+    # (see Diagram.schedule).
+    sample_time = None
+
+    # Number of elements of the input and output signals of blocks which work
+    # with vector signals (numpy arrays), None for scalar signals.
+    inputsize = outputsize = None
+
     def __init__(self, name, inputname, outputname):
         self.name = name
         self.inputname = inputname
@@ -12,9 +66,331 @@ class Block:
     def __repr__(self):
         return f"{self.__class__.__name__}: {self.inputname} →[ {self.name} ]→ {self.outputname}"
 
+    def snapshot(self):
+        """Return a copy of the state of the block which can be passed to restore
+
+        By default this copies all the attributes of the block, both those in
+        its slots and those in its __dict__.
+        """
+        attributes = {}
+        for cls in type(self).__mro__:
+            slots = getattr(cls, '__slots__', ())
+            for name in [slots] if isinstance(slots, str) else slots:
+                if name not in ('__dict__', '__weakref__') and hasattr(self, name):
+                    attributes[name] = getattr(self, name)
+        attributes.update(getattr(self, '__dict__', {}))
+        return copy.deepcopy(attributes)
+
+    def restore(self, snapshot):
+        """Restore the state of the block from a snapshot"""
+        for name, value in copy.deepcopy(snapshot).items():
+            setattr(self, name, value)
+
+    def euler(self, u, dt):
+        """Advance the state over dt with an explicit Euler step"""
+        self.change_state(self.state + self.derivative(u)*dt)
+
+
+def zoh(A, B, dt):
+    """Zero order hold discretisation of x' = Ax + Bu
+
+    :return Ad, Bd: matrices such that x(t + dt) = Ad x(t) + Bd u(t) for constant u
+    """
+    nx, nu = B.shape
+    M = numpy.zeros((nx + nu, nx + nu))
+    M[:nx, :nx] = A*dt
+    M[:nx, nx:] = B*dt
+    E = scipy.linalg.expm(M)
+    return E[:nx, :nx], E[:nx, nx:]
+
+
+class StateSpace:
+    """State space realisation x' = Ax + Bu, y = Cx + Du of a SISO system along with its state
+
+    Use state_space to construct the fastest realisation for the order of the system.
+    The cache of discretisations is only created when it is first used, since
+    most blocks are never discretised.
+    """
+    __slots__ = ('A', 'B', 'C', 'D', 'x', 'discretisations')
+
+    def __init__(self, A, B, C, D):
+        self.A, self.B, self.C, self.D = A, B, C, D
+        self.discretisations = None
+        self.reset()
+
+    def reset(self):
+        self.x = numpy.zeros((self.A.shape[0], 1))
+
+    def get_state(self):
+        return self.x
+
+    def set_state(self, x):
+        self.x = x
+
+    def output(self, u):
+        return (self.C.dot(self.x) + self.D.dot(u))[0, 0]
+
+    def derivative(self, u):
+        return self.A.dot(self.x) + self.B.dot(u)
+
+    def euler(self, u, dt):
+        self.x = self.x + self.derivative(u)*dt
+
+    def discretise(self, dt):
+        """Zero order hold discretisation of the realisation
+
+        The result is cached for each dt.
+
+        :param dt: timestep
+        :return Ad, Bd: matrices such that x(t + dt) = Ad x(t) + Bd u(t) for constant u
+        """
+        if self.discretisations is None:
+            self.discretisations = {}
+        if dt not in self.discretisations:
+            self.discretisations[dt] = zoh(self.A, self.B, dt)
+        return self.discretisations[dt]
+
+    def integrate(self, u, dt):
+        Ad, Bd = self.discretise(dt)
+        self.x = Ad.dot(self.x) + Bd.dot(u)
+
+    def discretisation_derivative(self, dt, dA, dB):
+        """Derivatives of the zero order hold discretisation for derivatives dA, dB of A, B
+
+        :return dAd, dBd: derivatives of the matrices returned by discretise
+        """
+        A, B = self.A, self.B
+        nx, nu = B.shape
+        M = numpy.zeros((nx + nu, nx + nu))
+        M[:nx, :nx] = A*dt
+        M[:nx, nx:] = B*dt
+        dM = numpy.zeros((nx + nu, nx + nu))
+        dM[:nx, :nx] = dA*dt
+        dM[:nx, nx:] = dB*dt
+        dE = scipy.linalg.expm_frechet(M, dM, compute_expm=False)
+        return dE[:nx, :nx], dE[:nx, nx:]
+
+
+class FirstOrderStateSpace(StateSpace):
+    """First order realisation using scalar arithmetic instead of arrays
+
+    Only the scalars are kept, so the matrices A, B, C, D are built when they
+    are asked for, which is only while compiling or analysing a diagram.
+    """
+    __slots__ = ('a', 'b', 'c', 'd', 'x1')
+
+    def __init__(self, A, B, C, D):
+        self.a, self.b, self.c, self.d = (float(M[0, 0]) for M in (A, B, C, D))
+        self.discretisations = None
+        self.reset()
+
+    A = property(lambda self: numpy.array([[self.a]]))
+    B = property(lambda self: numpy.array([[self.b]]))
+    C = property(lambda self: numpy.array([[self.c]]))
+    D = property(lambda self: numpy.array([[self.d]]))
+
+    def reset(self):
+        self.x1 = 0.0
+
+    def get_state(self):
+        return numpy.array([[self.x1]])
+
+    def set_state(self, x):
+        self.x1 = float(numpy.reshape(x, -1)[0])
+
+    def output(self, u):
+        return self.c*self.x1 + self.d*u
+
+    def derivative(self, u):
+        return numpy.array([[self.a*self.x1 + self.b*u]])
+
+    def euler(self, u, dt):
+        self.x1 += (self.a*self.x1 + self.b*u)*dt
+
+    def discretise(self, dt):
+        ad, bd = self.scalar_discretisation(dt)
+        return numpy.array([[ad]]), numpy.array([[bd]])
+
+    def scalar_discretisation(self, dt):
+        """Zero order hold discretisation as floats ad, bd, which is what is cached"""
+        if self.discretisations is None:
+            self.discretisations = {}
+        if dt not in self.discretisations:
+            Ad, Bd = zoh(self.A, self.B, dt)
+            self.discretisations[dt] = float(Ad[0, 0]), float(Bd[0, 0])
+        return self.discretisations[dt]
+
+    def integrate(self, u, dt):
+        ad, bd = self.scalar_discretisation(dt)
+        self.x1 = ad*self.x1 + bd*u
+
+
+class SecondOrderStateSpace(StateSpace):
+    """Second order realisation using scalar arithmetic instead of arrays
+
+    Like FirstOrderStateSpace, only the scalars are kept.
+    """
+    __slots__ = ('a11', 'a12', 'a21', 'a22', 'b1', 'b2', 'c1', 'c2', 'd', 'x1', 'x2')
+
+    def __init__(self, A, B, C, D):
+        (self.a11, self.a12), (self.a21, self.a22) = A.tolist()
+        (self.b1,), (self.b2,) = B.tolist()
+        (self.c1, self.c2), = C.tolist()
+        self.d = float(D[0, 0])
+        self.discretisations = None
+        self.reset()
+
+    A = property(lambda self: numpy.array([[self.a11, self.a12], [self.a21, self.a22]]))
+    B = property(lambda self: numpy.array([[self.b1], [self.b2]]))
+    C = property(lambda self: numpy.array([[self.c1, self.c2]]))
+    D = property(lambda self: numpy.array([[self.d]]))
+
+    def reset(self):
+        self.x1 = self.x2 = 0.0
+
+    def get_state(self):
+        return numpy.array([[self.x1], [self.x2]])
+
+    def set_state(self, x):
+        self.x1, self.x2 = (float(xi) for xi in numpy.reshape(x, -1))
+
+    def output(self, u):
+        return self.c1*self.x1 + self.c2*self.x2 + self.d*u
+
+    def derivative(self, u):
+        return numpy.array([[self.a11*self.x1 + self.a12*self.x2 + self.b1*u],
+                            [self.a21*self.x1 + self.a22*self.x2 + self.b2*u]])
+
+    def euler(self, u, dt):
+        x1, x2 = self.x1, self.x2
+        self.x1 = x1 + (self.a11*x1 + self.a12*x2 + self.b1*u)*dt
+        self.x2 = x2 + (self.a21*x1 + self.a22*x2 + self.b2*u)*dt
+
+    def integrate(self, u, dt):
+        ((a11, a12), (a21, a22)), (b1, b2) = self.scalar_discretisation(dt)
+        x1, x2 = self.x1, self.x2
+        self.x1 = a11*x1 + a12*x2 + b1*u
+        self.x2 = a21*x1 + a22*x2 + b2*u
+
+    def discretise(self, dt):
+        Ad, bd = self.scalar_discretisation(dt)
+        return numpy.array(Ad), numpy.array(bd).reshape(2, 1)
+
+    def scalar_discretisation(self, dt):
+        """Zero order hold discretisation as lists of floats Ad, bd, which is what is cached"""
+        if self.discretisations is None:
+            self.discretisations = {}
+        if dt not in self.discretisations:
+            Ad, Bd = zoh(self.A, self.B, dt)
+            self.discretisations[dt] = Ad.tolist(), Bd[:, 0].tolist()
+        return self.discretisations[dt]
+
+
+class MultivariableStateSpace(StateSpace):
+    """State space realisation with vector inputs and outputs"""
+    __slots__ = ()
+
+    def output(self, u):
+        return self.C.dot(self.x)[:, 0] + self.D.dot(u)
+
+    def derivative(self, u):
+        return self.A.dot(self.x) + self.B.dot(u).reshape(-1, 1)
+
+    def integrate(self, u, dt):
+        Ad, Bd = self.discretise(dt)
+        self.x = Ad.dot(self.x) + Bd.dot(u).reshape(-1, 1)
+
+
+def normalise(numerator, denominator=1):
+    """Normalised coefficients of a transfer function, as used for the keys of lti_matrices
+
+    Leading zeros are removed and the coefficients are divided by the leading
+    coefficient of the denominator, so equal transfer functions give equal keys.
+
+    :return numerator, denominator: tuples of floats
+    """
+    def trim(coefficients):
+        coefficients = [float(c) for c in numpy.ravel(coefficients).tolist()]
+        while coefficients and coefficients[0] == 0:
+            del coefficients[0]
+        return coefficients
+
+    numerator, denominator = trim(numerator), trim(denominator)
+    if denominator:
+        lead = denominator[0]
+        numerator, denominator = [c/lead for c in numerator], [c/lead for c in denominator]
+    return tuple(numerator) or (0.0,), tuple(denominator)
+
+
+@functools.lru_cache(maxsize=4096)
+def lti_matrices(numerator, denominator):
+    """State space matrices A, B, C, D of a transfer function in controllable canonical form
+
+    Converting with scipy.signal is slow compared to the rest of the block
+    construction, so the results are kept in a least recently used cache,
+    which is shared by all the blocks with the same transfer function. The
+    matrices are read only for that reason. Use lti_matrices.cache_info() for
+    the hit and miss statistics and lti_matrices.cache_clear() to empty it.
+
+    :param numerator, denominator: tuples of normalised coefficients (see normalise)
+    """
+    Gss = scipy.signal.lti(numerator, denominator).to_ss()
+    matrices = Gss.A, Gss.B, Gss.C, Gss.D
+    for M in matrices:
+        M.flags.writeable = False
+    return matrices
+
+
+def lti_matrix_derivatives(numerator, denominator, dnumerator, ddenominator):
+    """Derivatives of the matrices A, B, C, D of lti_matrices with respect to a parameter
+
+    The controllable canonical form of a transfer function with denominator
+    s**n + a1 s**(n - 1) + ... + an and numerator b0 s**n + ... + bn has the
+    -ai in the first row of A, B = [1, 0, ...], C = [b1 - b0 a1, ..., bn - b0 an]
+    and D = b0, so the derivatives follow from those of the coefficients.
+
+    :param numerator, denominator: coefficients of the transfer function in descending order
+    :param dnumerator, ddenominator: derivatives of the coefficients with respect to the parameter
+    :return dA, dB, dC, dD: arrays of the same shapes as the matrices
+    """
+    denominator = numpy.asarray(denominator, dtype=float)
+    ddenominator = numpy.asarray(ddenominator, dtype=float)
+    n = len(denominator) - 1
+    if n < 1 or denominator[0] == 0:
+        raise ValueError("The denominator must have a nonzero leading coefficient and order at least one")
+
+    def pad(coefficients):
+        coefficients = numpy.atleast_1d(numpy.asarray(coefficients, dtype=float))
+        if len(coefficients) > n + 1:
+            raise ValueError("The transfer function must be proper")
+        return numpy.concatenate([numpy.zeros(n + 1 - len(coefficients)), coefficients])
+
+    numerator, dnumerator = pad(numerator), pad(dnumerator)
+    lead, dlead = denominator[0], ddenominator[0]
+    a, b = denominator/lead, numerator/lead
+    da, db = (ddenominator - a*dlead)/lead, (dnumerator - b*dlead)/lead
+
+    dA = numpy.zeros((n, n))
+    dA[0] = -da[1:]
+    dB = numpy.zeros((n, 1))
+    dC = (db[1:] - db[0]*a[1:] - b[0]*da[1:]).reshape(1, n)
+    dD = numpy.array([[db[0]]])
+    return dA, dB, dC, dD
+
+
+def state_space(A, B, C, D):
+    """Return the fastest realisation for the order of the system
+
+    First and second order systems get scalar realisations, others are handled with arrays.
+    """
+    realisations = {1: FirstOrderStateSpace, 2: SecondOrderStateSpace}
+    return realisations.get(A.shape[0], StateSpace)(A, B, C, D)
+
 
 class LTI(Block):
     """Represents a general Linear Time Invariant system with optional delay"""
+    __slots__ = ('numerator', 'denominator', 'realisation', 'delay', 'y', 'output')
+
     def __init__(self, name, inputname, outputname, numerator, denominator=1, delay=0):
         """:param name: str, The name of the block
            :param inputname: str, the name of the input signal
@@ -26,8 +402,8 @@ class LTI(Block):
         """
         super().__init__(name, inputname, outputname)
 
-        self.G = scipy.signal.lti(numerator, denominator)
-        self.Gss = self.G.to_ss()
+        self.numerator, self.denominator = numerator, denominator
+        self.realisation = state_space(*lti_matrices(*normalise(numerator, denominator)))
         if delay > 0:
             self.delay = Deadtime(None, None, None, delay)
         else:
@@ -35,50 +411,144 @@ class LTI(Block):
         self.reset()
 
     def reset(self):
-        self.change_state(numpy.zeros((self.Gss.A.shape[0], 1)))
+        self.realisation.reset()
         self.y = self.output = 0
         if self.delay:
             self.delay.reset()
 
+    @property
+    def G(self):
+        return scipy.signal.lti(self.numerator, self.denominator)
+
+    @property
+    def Gss(self):
+        r = self.realisation
+        return scipy.signal.StateSpace(r.A, r.B, r.C, r.D)
+
+    @property
+    def x(self):
+        """State of the realisation as a column array, which can also be assigned to"""
+        return self.realisation.get_state()
+
+    @x.setter
+    def x(self, x):
+        self.change_state(numpy.asarray(x, dtype=float).reshape(-1, 1))
+
+    state = x
+
     def change_input(self, t, u):
-        self.y = (self.Gss.C.dot(self.x) + self.Gss.D.dot(u))[0, 0]
+        self.y = self.realisation.output(u)
         if self.delay:
             self.y = self.delay.change_input(t, self.y)
         self.output = self.y
         return self.output
 
     def change_state(self, x):
-        self.x = self.state = x
+        self.realisation.set_state(x)
+
+    @property
+    def feedthrough(self):
+        return self.delay is None and bool(numpy.any(self.realisation.D))
+
+    def snapshot(self):
+        return self.x.copy(), self.y, self.output, self.delay.snapshot() if self.delay else None
+
+    def restore(self, snapshot):
+        x, self.y, self.output, delay = snapshot
+        self.change_state(x.copy())
+        if self.delay:
+            self.delay.restore(delay)
 
     def derivative(self, e):
-        return self.Gss.A.dot(self.x) + self.Gss.B.dot(e)
+        return self.realisation.derivative(e)
+
+    def euler(self, u, dt):
+        self.realisation.euler(u, dt)
+
+    def discretise(self, dt):
+        """Zero order hold discretisation of the state space realisation
+
+        The result is cached for each dt.
+
+        :param dt: timestep
+        :return Ad, Bd: matrices such that x(t + dt) = Ad x(t) + Bd u(t) for constant u
+        """
+        return self.realisation.discretise(dt)
+
+    def integrate(self, u, dt):
+        """Advance the state exactly over dt, assuming u is constant"""
+        self.realisation.integrate(u, dt)
 
 
 class Controller(LTI):
+    __slots__ = ('automatic', 'parameters')
+
     def __init__(self, name, inputname, outputname, numerator, denominator=1, delay=0, automatic=True):
         self.automatic = True
+        self.parameters = {}
         super().__init__(name, inputname, outputname, numerator, denominator, delay)
 
+    def coefficient_derivatives(self, parameter):
+        """Derivatives of the numerator and denominator coefficients with respect to a parameter
+
+        :param parameter: name of one of the parameters
+        :return dnumerator, ddenominator: lists of the same lengths as the coefficients
+        """
+        raise ValueError(f"The controller '{self.name}' has no parameter '{parameter}'")
+
+    def realisation_derivatives(self, parameter):
+        """Derivatives of the realisation matrices A, B, C, D with respect to a parameter
+
+        These are used to calculate sensitivities (see SensitivityDiagram)
+        """
+        if parameter not in self.parameters:
+            raise ValueError(f"The controller '{self.name}' has no parameter '{parameter}', "
+                             f"use one of {list(self.parameters)}")
+        derivatives = lti_matrix_derivatives(self.numerator, self.denominator,
+                                             *self.coefficient_derivatives(parameter))
+        if derivatives[0].shape != self.realisation.A.shape:
+            raise ValueError(f"The realisation of '{self.name}' has a lower order than its transfer function")
+        return derivatives
+
     def change_input(self, t, u):
         if self.automatic:
             return super().change_input(t, u)
         else:
             return self.output
 
+    @property
+    def feedthrough(self):
+        return self.automatic and super().feedthrough
+
 class PI(Controller):
+    __slots__ = ()
+
     def __init__(self, name, inputname, outputname, Kc, tau_i):
         """Textbook PI controller"""
         super().__init__(name, inputname, outputname, [Kc*tau_i, Kc], [tau_i, 0])
+        self.parameters = {'Kc': Kc, 'tau_i': tau_i}
+
+    def coefficient_derivatives(self, parameter):
+        Kc, tau_i = self.parameters['Kc'], self.parameters['tau_i']
+        if parameter == 'Kc':
+            return [tau_i, 1], [0, 0]
+        if parameter == 'tau_i':
+            return [Kc, 0], [1, 0]
+        return super().coefficient_derivatives(parameter)
 
 
 class PID(Controller):
+    __slots__ = ()
+
     def __init__(self, name, inputname, outputname, Kc, tau_i, tau_d=0, alpha_f=0.1):
         """Standard realisable parallel form ISA PID controller with first order filter.
 
-        If tau_d=0, a PI controller is returned"""
+        If tau_d=0, the controller is a PI controller"""
 
         if tau_d == 0:
-            return PI(name, inputname, outputname, Kc, tau_i)
+            super().__init__(name, inputname, outputname, [Kc*tau_i, Kc], [tau_i, 0])
+            self.parameters = {'Kc': Kc, 'tau_i': tau_i, 'tau_d': tau_d, 'alpha_f': alpha_f}
+            return
 
         super().__init__(name, inputname, outputname,
                          numerator=[Kc*alpha_f*tau_d*tau_i + Kc*tau_d*tau_i,
@@ -87,9 +557,166 @@ class PID(Controller):
                          denominator=[alpha_f*tau_d*tau_i,
                                       tau_i,
                                       0.0])
+        self.parameters = {'Kc': Kc, 'tau_i': tau_i, 'tau_d': tau_d, 'alpha_f': alpha_f}
+
+    def coefficient_derivatives(self, parameter):
+        Kc, tau_i, tau_d, alpha_f = (self.parameters[p] for p in ('Kc', 'tau_i', 'tau_d', 'alpha_f'))
+        if tau_d == 0:
+            if parameter == 'tau_d':
+                raise ValueError("The derivative with respect to tau_d at tau_d=0 is not proper")
+            if parameter == 'Kc':
+                return [tau_i, 1], [0, 0]
+            if parameter == 'tau_i':
+                return [Kc, 0], [1, 0]
+            if parameter == 'alpha_f':
+                return [0, 0], [0, 0]
+            return super().coefficient_derivatives(parameter)
+        if parameter == 'Kc':
+            return [(alpha_f + 1)*tau_d*tau_i, alpha_f*tau_d + tau_i, 1], [0, 0, 0]
+        if parameter == 'tau_i':
+            return [Kc*(alpha_f + 1)*tau_d, Kc, 0], [alpha_f*tau_d, 1, 0]
+        if parameter == 'tau_d':
+            return [Kc*(alpha_f + 1)*tau_i, Kc*alpha_f, 0], [alpha_f*tau_i, 0, 0]
+        if parameter == 'alpha_f':
+            return [Kc*tau_d*tau_i, Kc*tau_d, 0], [tau_d*tau_i, 0, 0]
+        return super().coefficient_derivatives(parameter)
+
+
+class MIMO(LTI):
+    """Multivariable LTI system with vector input and output signals
+
+    The system is advanced with one matrix product per step, which is much
+    faster than building it from SISO blocks and sums. Use from_transfer_matrix
+    to specify the system as a matrix of transfer functions.
+    """
+    __slots__ = ('inputsize', 'outputsize', 'delays', 'summation')
+
+    def __init__(self, name, inputname, outputname, A, B, C, D, delay=0, summation=None):
+        """:param name: str, The name of the block
+           :param inputname: str, the name of the input signal
+           :param outputname: str, the name of the output signal
+           :param A, B, C, D: state space matrices, x' = Ax + Bu, w = Cx + Du
+           :param delay: number or iterable of numbers, delay of each element of w
+           :param summation: optional matrix S so that the output is y = Sw after the delays,
+                             otherwise y = w
+
+        """
+        Block.__init__(self, name, inputname, outputname)
+
+        A, B, C, D = (numpy.atleast_2d(numpy.asarray(M, dtype=float)) for M in (A, B, C, D))
+        nx, nw = A.shape[0], C.shape[0]
+        if A.shape != (nx, nx) or B.shape[0] != nx or C.shape[1] != nx or D.shape != (nw, B.shape[1]):
+            raise ValueError(f"Inconsistent state space matrices for {name}")
+        self.numerator = self.denominator = None
+        self.realisation = MultivariableStateSpace(A, B, C, D)
+        self.delay = None
+        self.delays = [(k, Deadtime(None, None, None, d))
+                       for k, d in enumerate(numpy.broadcast_to(delay, (nw,))) if d > 0]
+        self.summation = None if summation is None else numpy.atleast_2d(numpy.asarray(summation, dtype=float))
+        self.inputsize = B.shape[1]
+        self.outputsize = nw if self.summation is None else self.summation.shape[0]
+        self.reset()
+
+    @classmethod
+    def from_transfer_matrix(cls, name, inputname, outputname, numerators, denominators, delays=0):
+        """Create a block from a matrix of transfer functions, like the Wood-Berry column
+
+        :param numerators: nested list of numerators, one row for each output
+        :param denominators: nested list of denominators with the same shape
+        :param delays: number or nested list of delays with the same shape
+
+        Elements in the same row with the same delay share a delay, so the
+        elements are only summed after the delays when they differ.
+
+        Example
+
+        >>> G = MIMO.from_transfer_matrix('G', 'u', 'y',
+        ...                               [[12.8, -18.9], [6.6, -19.4]],
+        ...                               [[[16.7, 1], [21, 1]], [[10.9, 1], [14.4, 1]]],
+        ...                               [[1, 3], [7, 3]])
+        """
+        ny, nu = len(numerators), len(numerators[0])
+        delays = numpy.broadcast_to(delays, (ny, nu))
+
+        elements = []
+        for i in range(ny):
+            for j in range(nu):
+                if not numpy.any(numerators[i][j]):
+                    continue
+                Ae, Be, Ce, De = lti_matrices(*normalise(numerators[i][j], denominators[i][j]))
+                if not numpy.any(Ce):
+                    # Static gains have a dummy state which is not needed
+                    Ae, Be, Ce = numpy.zeros((0, 0)), numpy.zeros((0, 1)), numpy.zeros((1, 0))
+                elements.append((i, j, delays[i, j], (Ae, Be, Ce, De)))
+
+        groups = sorted({(i, d) for i, j, d, matrices in elements})
+        nx = sum(Ae.shape[0] for *_, (Ae, Be, Ce, De) in elements)
+        A = numpy.zeros((nx, nx))
+        B = numpy.zeros((nx, nu))
+        C = numpy.zeros((len(groups), nx))
+        D = numpy.zeros((len(groups), nu))
+        start = 0
+        for i, j, d, (Ae, Be, Ce, De) in elements:
+            states = slice(start, start + Ae.shape[0])
+            g = groups.index((i, d))
+            A[states, states] = Ae
+            B[states, j] = Be[:, 0]
+            C[g, states] = Ce[0]
+            D[g, j] += De[0, 0]
+            start = states.stop
+
+        group_delays = [d for i, d in groups]
+        if [i for i, d in groups] == list(range(ny)):
+            summation = None
+        else:
+            summation = numpy.zeros((ny, len(groups)))
+            for g, (i, d) in enumerate(groups):
+                summation[i, g] = 1
+        block = cls(name, inputname, outputname, A, B, C, D, group_delays, summation)
+        block.numerator, block.denominator = numerators, denominators
+        return block
+
+    def reset(self):
+        self.realisation.reset()
+        self.y = self.output = numpy.zeros(self.outputsize)
+        for k, delay in self.delays:
+            delay.reset()
+
+    @property
+    def G(self):
+        """Matrix of transfer functions as nested lists of scipy.signal.lti, without the delays"""
+        if self.numerator is None:
+            raise AttributeError(f"{self.name} was not specified as a transfer matrix")
+        return [[scipy.signal.lti(n, d) for n, d in zip(nrow, drow)]
+                for nrow, drow in zip(self.numerator, self.denominator)]
+
+    def change_input(self, t, u):
+        w = self.realisation.output(u)
+        for k, delay in self.delays:
+            w[k] = delay.change_input(t, w[k])
+        self.y = self.output = w if self.summation is None else self.summation.dot(w)
+        return self.output
+
+    @property
+    def feedthrough(self):
+        delayed = [k for k, delay in self.delays]
+        return bool(numpy.any(numpy.delete(self.realisation.D, delayed, axis=0)))
+
+    def snapshot(self):
+        return self.x.copy(), self.y.copy(), [delay.snapshot() for k, delay in self.delays]
+
+    def restore(self, snapshot):
+        x, y, delays = snapshot
+        self.change_state(x.copy())
+        self.y = self.output = y.copy()
+        for (k, delay), delay_snapshot in zip(self.delays, delays):
+            delay.restore(delay_snapshot)
 
 
 class Zero(Block):
+    __slots__ = ('x', 'state')
+    feedthrough = False
+
     def __init__(self, name, inputname, outputname):
         super().__init__(name, inputname, outputname)
 
@@ -103,11 +730,19 @@ class Zero(Block):
     def change_state(self, x):
         self.x = self.state = 0
 
+    def snapshot(self):
+        return None
+
+    def restore(self, snapshot):
+        pass
+
     def derivative(self, e):
         return 0
 
 
 class AlgebraicEquation(Block):
+    __slots__ = ('f', 'x', 'state', 'y', 'output')
+
     def __init__(self, name, inputname, outputname, f):
         """Relationship between input and output specified by an external function
 
@@ -125,6 +760,13 @@ class AlgebraicEquation(Block):
         self.y = self.output = self.f(t, u)
         return self.output
 
+    def snapshot(self):
+        return self.x, self.y, self.output
+
+    def restore(self, snapshot):
+        x, self.y, self.output = snapshot
+        self.change_state(x)
+
     def change_state(self, x):
         self.x = self.state = x
 
@@ -133,6 +775,16 @@ class AlgebraicEquation(Block):
 
     
 class Deadtime(Block):
+    """Delays its input by a fixed amount of time
+
+    The input history is kept in a circular buffer which only holds the
+    samples spanning the delay, so the memory use is bounded and each step
+    only interpolates between the two samples bracketing the delayed time.
+    The buffer grows as needed until it covers the delay, so it settles at
+    about delay/dt samples. Times are assumed to increase monotonically.
+    """
+    __slots__ = ('delay', 'x', 'state', 'y', 'output', 'ts', 'us', 'start', 'count')
+
     def __init__(self, name, inputname, outputname, delay):
         super().__init__(name, inputname, outputname)
 
@@ -142,19 +794,71 @@ class Deadtime(Block):
     def reset(self):
         self.change_state(0)
         self.y = self.output = 0
-        self.ts = [0]
-        self.us = [0]
+        self.ts = numpy.zeros(16)
+        self.us = numpy.zeros(16)
+        self.start = 0
+        self.count = 1
 
     def change_input(self, t, u):
-        self.ts.append(t)
-        self.us.append(u)
+        # Without a delay the output is the input, so no history is kept
         if self.delay > 0:
-            u = numpy.interp(t - self.delay, self.ts, self.us)
+            self.append(t, u)
+            u = self.interpolate(t - self.delay)
 
         self.y = u
         self.output = self.y
         return self.output
 
+    def append(self, t, u):
+        capacity = len(self.ts)
+        if self.count == capacity:
+            order = (self.start + numpy.arange(capacity)) % capacity
+            self.ts = numpy.concatenate([self.ts[order], numpy.zeros(capacity)])
+            self.us = numpy.concatenate([self.us[order], numpy.zeros(capacity)])
+            self.start = 0
+            capacity *= 2
+        end = (self.start + self.count) % capacity
+        self.ts[end] = t
+        self.us[end] = u
+        self.count += 1
+
+    @property
+    def feedthrough(self):
+        return self.delay <= 0
+
+    def history(self):
+        """Return the times and values in the buffer in order"""
+        order = (self.start + numpy.arange(self.count)) % len(self.ts)
+        return self.ts[order], self.us[order]
+
+    def snapshot(self):
+        return self.history(), self.x, self.y, self.output
+
+    def restore(self, snapshot):
+        (ts, us), x, self.y, self.output = snapshot
+        self.change_state(x)
+        capacity = max(16, 2*len(ts))
+        self.ts = numpy.zeros(capacity)
+        self.us = numpy.zeros(capacity)
+        self.ts[:len(ts)] = ts
+        self.us[:len(us)] = us
+        self.start = 0
+        self.count = len(ts)
+
+    def interpolate(self, t):
+        """Interpolate the input history at time t, discarding samples before t"""
+        ts, us = self.ts, self.us
+        capacity = len(ts)
+        second = (self.start + 1) % capacity
+        while self.count > 1 and ts[second] <= t:
+            self.start = second
+            self.count -= 1
+            second = (second + 1) % capacity
+        first = self.start
+        if self.count == 1 or t <= ts[first]:
+            return us[first]
+        return us[first] + (us[second] - us[first])*(t - ts[first])/(ts[second] - ts[first])
+
     def change_state(self, x):
         self.x = self.state = x
 
@@ -163,7 +867,8 @@ class Deadtime(Block):
 
     
 class DiscreteTF(Block):
-    
+    __slots__ = ('dt', 'y_cos', 'u_cos', 'ys', 'us', 'tick', 'state', 'output')
+
     def __init__(self, name, input_name, output_name, dt, numerator, denominator):
         """
         Represents a discrete transfer function.
@@ -200,35 +905,59 @@ class DiscreteTF(Block):
         self.y_cos = denominator[::-1]
         self.u_cos = numerator[::-1]
 
-        self.ys = numpy.zeros(len(self.y_cos))
-        self.us = numpy.zeros(len(self.u_cos))
-        self.next_sample = 0
-
-        self.state = 0.0
-        self.output = 0.0
+        self.reset()
 
     def reset(self):
         self.ys = numpy.zeros(len(self.y_cos))
         self.us = numpy.zeros(len(self.u_cos))
-        self.next_sample = 0
+        self.tick = 0
         self.state = 0.0
         self.output = 0.0
-    
+
+    @property
+    def sample_time(self):
+        return self.dt
+
+    @property
+    def next_sample(self):
+        """Time of the next sample
+
+        Samples are counted with the integer self.tick, so the sample instants
+        are exact multiples of dt and do not drift.
+        """
+        return self.tick*self.dt
+
     def change_input(self, t, u):
-        if t > self.next_sample:
-            self.next_sample += self.dt
-            
-            self.us[:-1] = self.us[1:]
-            self.us[-1] = u
-            
-            self.ys[:-1] = self.ys[1:]
-            self.ys[-1] = None # done to ensure that if anything should go wrong, it does  
-            
-            u_sum = numpy.inner(self.u_cos, self.us)
-            y_sum = numpy.inner(self.y_cos[:-1], self.ys[:-1])
-            y = (u_sum - y_sum)/self.y_cos[-1]
-
-            self.output = self.ys[-1] = y
+        if t >= (self.tick - SAMPLE_TOLERANCE)*self.dt:
+            self.tick = int(t/self.dt + SAMPLE_TOLERANCE) + 1
+            self.sample(u)
+        return self.output
+
+    @property
+    def feedthrough(self):
+        return self.u_cos[-1] != 0
+
+    def snapshot(self):
+        return self.ys.copy(), self.us.copy(), self.tick, self.state, self.output
+
+    def restore(self, snapshot):
+        ys, us, self.tick, self.state, self.output = snapshot
+        self.ys = ys.copy()
+        self.us = us.copy()
+
+    def sample(self, u):
+        """Take a sample of the input and calculate the new output"""
+        self.us[:-1] = self.us[1:]
+        self.us[-1] = u
+
+        self.ys[:-1] = self.ys[1:]
+        self.ys[-1] = None # done to ensure that if anything should go wrong, it does  
+
+        u_sum = numpy.inner(self.u_cos, self.us)
+        y_sum = numpy.inner(self.y_cos[:-1], self.ys[:-1])
+        y = (u_sum - y_sum)/self.y_cos[-1]
+
+        self.output = self.ys[-1] = y
         return self.output
     
     def change_state(self, x):
@@ -246,6 +975,7 @@ class Diagram:
         :param blocks: list of blocks
         :param sums: sums specified as dictionaries with keys equal to output signal and values as tuples of strings of the form "<sign><signal>"
         :param inputs: inputs specified as dictionaries with keys equal to signal names and values functions of time
+                       returning numbers, or arrays for vector signals (see MIMO)
         
         
         Example
@@ -269,68 +999,2081 @@ class Diagram:
         self.reset()
 
     def reset(self):
+        self.sizes = self.signal_sizes()
         self.signals = {b.inputname: 0 for b in self.blocks}
         self.signals.update({b.outputname: 0 for b in self.blocks})
         self.signals.update({output: 0 for output in self.sums})
+        self.signals.update({signal: 0 for signal in self.inputs})
+        for name, size in self.sizes.items():
+            self.signals[name] = numpy.zeros(size)
         for block in self.blocks:
             block.reset()
+        self.time = 0
+        self.compile_routing()
 
-    def step(self, t, dt):
+    def signal_sizes(self):
+        """Number of elements of each vector signal
+
+        The sizes are taken from the blocks (see Block.inputsize) and are
+        shared by all the signals in a sum. Scalar signals are left out.
+
+        Returns a dictionary with keys equal to signal names and values sizes
+        """
+        sizes = {}
+        for block in self.blocks:
+            for name, size in [(block.inputname, block.inputsize), (block.outputname, block.outputsize)]:
+                if size is not None and sizes.setdefault(name, size) != size:
+                    raise ValueError(f"The signal '{name}' is used with sizes {sizes[name]} and {size}")
+        changed = True
+        while changed:
+            changed = False
+            for output, inputs in self.sums.items():
+                names = [output] + [s[1:] for s in inputs]
+                known = {sizes[name] for name in names if name in sizes}
+                if len(known) > 1:
+                    raise ValueError(f"The signals in the sum '{output}': {inputs} have different sizes")
+                if known:
+                    size = known.pop()
+                    for name in names:
+                        if name not in sizes:
+                            sizes[name] = size
+                            changed = True
+        return sizes
+
+    def snapshot(self):
+        """Return the state of the diagram and all its blocks
+
+        The snapshot can be passed to restore or to simulate as the initial
+        state to continue a simulation from this point, as often as needed.
+
+        Returns a dictionary with the time the state corresponds to, the signal
+        values and a list of block snapshots in the order of the blocks.
+        """
+        return {'time': self.time,
+                'signals': dict(self.signals),
+                'blocks': [block.snapshot() for block in self.blocks]}
+
+    def restore(self, snapshot):
+        """Restore the state of the diagram from a snapshot taken with Diagram.snapshot"""
+        if len(snapshot['blocks']) != len(self.blocks):
+            raise ValueError("The snapshot is not of this diagram")
+        self.signals = dict(snapshot['signals'])
+        for block, block_snapshot in zip(self.blocks, snapshot['blocks']):
+            block.restore(block_snapshot)
+        self.time = snapshot['time']
+        self.compile_routing()
+
+    def initialise_steady_state(self, inputs=None, t=0):
+        """Set the diagram to the steady state for constant inputs, so simulations start at an operating point
+
+        The signals and the states of all the blocks are solved for together,
+        with the derivatives of the LTI blocks zero, delays passing their input
+        and DiscreteTF blocks at their gain at z=1. Manual controllers hold
+        their output. The linear equations are solved directly and
+        AlgebraicEquation blocks with scipy.optimize.root, starting from the
+        solution with their outputs equal to their inputs.
+
+        :param inputs: dictionary of values of the input signals. Inputs which are left
+                       out are held at the values of the input functions at t
+        :param t: time of the steady state
+        :return: snapshot of the diagram (see snapshot), which can be passed to
+                 simulate as the initial state
+
+        Raises ValueError if there is no steady state, for instance when an
+        integrator has a constant nonzero input.
+        """
+        self.reset()
+        held = {name: function(t) for name, function in self.inputs.items()}
+        held.update(inputs or {})
+
+        # Unknowns are the rows of the signals, followed by the states of the LTI blocks
+        rows = {}
+        n = 0
+        for name in self.signal_names:
+            size = self.sizes.get(name) or 1
+            rows[name] = list(range(n, n + size))
+            n += size
+        states = {}
+        for block in self.blocks:
+            if isinstance(block, LTI) and not (isinstance(block, Controller) and not block.automatic):
+                nx = block.realisation.A.shape[0]
+                states[block] = list(range(n, n + nx))
+                n += nx
+
+        M = numpy.zeros((n, n))
+        r = numpy.zeros(n)
+        k = 0
+
+        def equation(value, *terms):
+            """Add the equations sum(matrix.dot(v[columns])) = value for terms (columns, matrix)"""
+            nonlocal k
+            neq = numpy.shape(terms[0][1])[0]
+            for columns, matrix in terms:
+                M[k:k + neq, columns] += matrix
+            r[k:k + neq] = value
+            k += neq
+
+        def identity(name):
+            return numpy.eye(len(rows[name]))
+
+        produced = set(self.sums) | {block.outputname for block in self.blocks}
+        for name in self.signal_names:
+            if name not in produced:
+                value = held.get(name, self.signals[name])
+                equation(numpy.broadcast_to(value, len(rows[name])), (rows[name], identity(name)))
+        for output, terms in self.sums.items():
+            equation(0, (rows[output], identity(output)),
+                     *[(rows[s[1:]], -int(s[0] + '1')*identity(output)) for s in terms])
+        algebraic = []
+        for block in self.blocks:
+            u, y = rows[block.inputname], rows[block.outputname]
+            if isinstance(block, Zero):
+                equation(0, (y, numpy.eye(len(y))))
+            elif block in states:
+                R = block.realisation
+                S = getattr(block, 'summation', None)
+                S = numpy.eye(R.C.shape[0]) if S is None else S
+                equation(0, (states[block], R.A), (u, R.B))
+                equation(0, (y, numpy.eye(len(y))), (states[block], -S.dot(R.C)), (u, -S.dot(R.D)))
+            elif isinstance(block, Controller):
+                equation(block.output, (y, [[1]]))
+            elif isinstance(block, Deadtime):
+                equation(0, (y, [[1]]), (u, [[-1]]))
+            elif isinstance(block, DiscreteTF):
+                equation(0, (y, [[sum(block.y_cos)]]), (u, [[-sum(block.u_cos)]]))
+            elif isinstance(block, AlgebraicEquation):
+                algebraic.append((block, k))
+                equation(0, (y, [[1]]), (u, [[-1]]))
+            else:
+                raise ValueError(f"The steady state of the block '{block.name}' is not known")
+
+        def residual(v):
+            e = M.dot(v) - r
+            for block, i in algebraic:
+                e[i] = v[rows[block.outputname][0]] - block.f(t, v[rows[block.inputname][0]])
+            return e
+
+        v = numpy.linalg.lstsq(M, r, rcond=None)[0]
+        if algebraic:
+            v = scipy.optimize.root(residual, v).x
+        if numpy.max(numpy.abs(residual(v)), initial=0) > 1e-8*max(1, numpy.max(numpy.abs(v), initial=0)):
+            raise ValueError("The diagram has no steady state for these inputs")
+
+        for name in self.signal_names:
+            self.signals[name] = v[rows[name]].copy() if name in self.sizes else float(v[rows[name][0]])
         signals = self.signals
-        # Evaluate all inputs
-        for signal, function in self.inputs.items():
-            signals[signal] = function(t)
-        # Evaluate sums
-        for output, inputs in self.sums.items():
-            signals[output] = sum(int(s[0]+'1')*signals[s[1:]] for s in inputs)
-        # Evaluate blocks and integrate
+
+        def hold(delay, value):
+            delay.restore(((numpy.array([t - delay.delay]), numpy.array([value])), delay.x, value, value))
+
         for block in self.blocks:
-            u = signals[block.inputname]
-            signals[block.outputname] = block.change_input(t, u)
-            block.change_state(block.state + block.derivative(u)*dt)
+            u, y = signals[block.inputname], signals[block.outputname]
+            if block in states:
+                block.change_state(v[states[block]].reshape(-1, 1))
+                if isinstance(block, MIMO):
+                    w = block.realisation.output(u)
+                    for i, delay in block.delays:
+                        hold(delay, w[i])
+                elif block.delay:
+                    hold(block.delay, y)
+                block.y = block.output = y
+            elif isinstance(block, Deadtime):
+                hold(block, u)
+            elif isinstance(block, DiscreteTF):
+                tick = int(numpy.ceil(t/block.dt - SAMPLE_TOLERANCE))
+                block.restore((numpy.full(len(block.y_cos), y), numpy.full(len(block.u_cos), u),
+                               tick, block.state, y))
+            elif isinstance(block, AlgebraicEquation):
+                block.y = block.output = y
+        self.time = t
+        self.compile_routing()
+        return self.snapshot()
+
+    def compile_routing(self):
+        """Precompile the evaluation order and signal routing used by step
+
+        Signals are stored in the flat list self.values in the order of
+        self.signal_names. Sums are compiled to tuples of (index, sign) and
+        the sums and blocks are sorted so that every signal is calculated
+        before it is used (see evaluation_order), which makes the results
+        independent of the order of the blocks.
+
+        Blocks with a sample_time are left out of self.continuous_program,
+        which is used between their sample instants (see schedule).
+        """
+        self.signal_names = list(self.signals)
+        index = {name: i for i, name in enumerate(self.signal_names)}
+        self.values = list(self.signals.values())
+        self.order = self.evaluation_order(lambda block: block.feedthrough)
+        self.input_program = [(index[signal], function) for signal, function in self.inputs.items()]
+        self.program = []
+        for output, inputs in self.sums.items():
+            for s in inputs:
+                if s[1:] not in index:
+                    raise ValueError(f"In the sum '{output}': {inputs}, there is no signal called '{s[1:]}'")
+        for kind, item in self.order:
+            if kind == 'sum':
+                terms = tuple((index[s[1:]], int(s[0]+'1')) for s in self.sums[item])
+                self.program.append((index[item], terms, None, None))
+            else:
+                self.program.append((index[item.outputname], None, item, index[item.inputname]))
+        self.sampled = [block for block in self.blocks if block.sample_time is not None]
+        self.continuous_program = [entry for entry in self.program
+                                   if entry[2] is None or entry[2].sample_time is None]
+        self.integrators = [(block, index[block.inputname]) for block in self.blocks
+                            if block.sample_time is None]
+        self.next_event = self.schedule()
+
+    def schedule(self):
+        """Time from which the next sample of any of the sampled blocks is due
+
+        Sampled blocks are only evaluated on the timesteps at or after their
+        sample instants, in between their outputs are held. If the rest of the
+        diagram is linear, Diagram.simulate solves all the timesteps between
+        two samples at once (see CompiledDiagram.solve), so the Python work
+        scales with the number of samples rather than timesteps.
+        """
+        return min([block.next_sample - SAMPLE_TOLERANCE*block.sample_time for block in self.sampled],
+                   default=numpy.inf)
+
+    def step(self, t, dt, method='euler'):
+        """Advance the diagram by one timestep
+
+        :param t: current time
+        :param dt: timestep
+        :param method: 'euler' to integrate all states with explicit Euler or
+                       'zoh' to advance LTI blocks with their exact zero order
+                       hold discretisation (see LTI.discretise)
+        """
+        values = self.advance(t, dt, method)
+        signals = self.signals
+        for name, value in zip(self.signal_names, values):
+            signals[name] = value
         return signals
 
-    def simulate(self, ts, progress=False):
+    def advance(self, t, dt, method='euler', input_program=None):
+        """Advance the diagram by one timestep like step, but return the flat list of signal values
+
+        :param input_program: list of (index, function) of the inputs to evaluate,
+                              all of them if None. The others must already be set in self.values
+        """
+        values = self.values
+        # Evaluate all inputs
+        for i, function in self.input_program if input_program is None else input_program:
+            values[i] = function(t)
+        # Evaluate sums and blocks in causal order, sampled blocks only when they are due
+        sample = t >= self.next_event
+        for output, terms, block, i in self.program if sample else self.continuous_program:
+            if block is None:
+                values[output] = sum([sign*values[j] for j, sign in terms])
+            else:
+                values[output] = block.change_input(t, values[i])
+        if sample:
+            self.next_event = self.schedule()
+        # Integrate once all the inputs are known
+        zoh = method == 'zoh'
+        for block, i in self.integrators:
+            if zoh and isinstance(block, LTI):
+                block.integrate(values[i], dt)
+            else:
+                block.euler(values[i], dt)
+        return values
+
+    def advance_profiled(self, t, dt, method, profile):
+        """Advance the diagram like advance, recording the time taken by each part in a Profile"""
+        values = self.values
+        names = self.signal_names
+        for i, function in self.input_program:
+            values[i] = profile.call('input', names[i], function, t)
+        sample = t >= self.next_event
+        for output, terms, block, i in self.program if sample else self.continuous_program:
+            if block is None:
+                values[output] = profile.call('sum', names[output],
+                                              lambda: sum([sign*values[j] for j, sign in terms]))
+            else:
+                values[output] = profile.call('block', block.name, block.change_input, t, values[i])
+        if sample:
+            self.next_event = self.schedule()
+        zoh = method == 'zoh'
+        for block, i in self.integrators:
+            integrate = block.integrate if zoh and isinstance(block, LTI) else block.euler
+            profile.call('integrate', block.name, integrate, values[i], dt)
+        return values
+
+    def simulate(self, ts, progress=False, compiled=False, record=None, decimate=1, method='euler',
+                 solver_options=None, initial=None, profile=False, store=None, metrics=None,
+                 closed_form=True):
         """Simulate diagram
 
         :param ts: iterable, timesteps to simulate. Note this should be equally spaced
         :param progress: display progress bar
-
-        Returns dictionary with keys for each signal in the diagram and values an iterable of values
+        :param compiled: assemble the linear blocks into a single state space
+                         system and advance it with matrix operations (see CompiledDiagram),
+                         or 'generated' to run a function generated for the diagram (see compile)
+        :param record: iterable of signal names to record. All signals are recorded if None
+        :param decimate: only record every decimate'th timestep
+        :param method: integration method, 'euler' or 'zoh' (see Diagram.step) or
+                       'adaptive' to use an adaptive step ODE solver (see AdaptiveSolver)
+        :param solver_options: dictionary of keyword arguments for AdaptiveSolver
+        :param initial: snapshot from Diagram.snapshot to start from instead of
+                        resetting the diagram. ts should then start at the time
+                        of the snapshot
+        :param profile: True to record the time taken and number of calls for each
+                        input, sum and block in self.profile (see Profile), or
+                        'memory' to also record the memory they allocate, which
+                        is much slower. Profiling adds no overhead when it is off
+
+        :param store: directory to store the result in, see SimulationResult.create. The
+                      signals are written to a memory-mapped file as they are calculated
+        :param metrics: dictionary with keys equal to names and values Metrics, which are
+                        accumulated at every timestep and returned in result.metrics.
+                        Their signals need not be recorded, so with record=[] only
+                        the metrics are kept, except by the adaptive method, which
+                        keeps their signals at every time until the end
+        :param closed_form: True to solve diagrams which only contain linear blocks
+                            without delays (see linear) in closed form for blocks of
+                            CHUNK_SIZE times at once (see CompiledDiagram.solve),
+                            which gives the same result much faster. If they also
+                            contain sampled blocks, only the samples are stepped
+                            through and the times between them are solved at once.
+                            False to always step through the times as chosen by compiled
+
+        Returns a SimulationResult, which maps each recorded signal name to an array of values
         """
 
+        if method not in METHODS:
+            raise ValueError(f"Unknown integration method '{method}', use one of {METHODS}")
+        if profile and (method == 'adaptive' or compiled == 'generated'):
+            raise ValueError("Profiling is only supported with the 'euler' and 'zoh' methods, "
+                             "and not for generated functions")
         if progress:
             from tqdm.auto import tqdm as tqdm
             pbar = tqdm(total=len(ts))
-        dt = ts[1]
-        outputs = defaultdict(list)
+        dt = ts[1] - ts[0]
         self.reset()
-        for t in ts:
-            newoutputs = self.step(t, dt)
-            for signal, value in newoutputs.items():
-                outputs[signal].append(value)
-            if progress:
-                pbar.update()
-        return outputs
+        if initial is not None:
+            self.restore(initial)
+        names = self.record_names(record)
+        if store is None:
+            result = SimulationResult(names, numpy.asarray(ts)[::decimate], sizes=self.sizes)
+        else:
+            result = SimulationResult.create(store, names, numpy.asarray(ts)[::decimate], self.sizes)
+        data = result.data
+
+        metrics = metrics or {}
+        for name, metric in metrics.items():
+            if not isinstance(metric, Metric):
+                raise TypeError(f"The metric '{name}' is not a Metric, so it cannot be accumulated")
+        probes = self.record_names(sorted({signal for metric in metrics.values() for signal in metric.signals}))
+        if any(name in self.sizes for name in probes):
+            raise ValueError("Metrics can only be accumulated for scalar signals")
+        extra = [name for name in probes if name not in names]
+
+        nrows = len(data)
+        columns = {name: result.index[name] if name in result.index else nrows + extra.index(name)
+                   for name in probes}
+        accumulators = [(metric, metric.start(), [columns[signal] for signal in metric.signals])
+                        for metric in metrics.values()]
+
+        def finish_metrics():
+            result.metrics = {name: metric.finish(state)
+                              for name, (metric, state, signals) in zip(metrics, accumulators)}
+            result.flush()
+
+        if method == 'adaptive':
+            # The adaptive solver interpolates onto all the times at the end, so the
+            # signals of the metrics are recorded at every time and accumulated afterwards
+            full = SimulationResult(names + extra, numpy.asarray(ts), sizes=self.sizes) if metrics else result
+            AdaptiveSolver(self, **(solver_options or {})).simulate(ts, full, pbar if progress else None)
+            if full is not result:
+                data[:] = full.data[:nrows, ::decimate]
+                for metric, state, signals in accumulators:
+                    metric.extend(state, full.t, *full.data[signals])
+            finish_metrics()
+            self.time = ts[-1]
+            return result
+
+        def solve_blocks(engine, solve):
+            # Solvers which calculate blocks of times at once return all the signals in
+            # names + extra for each block, which are recorded every decimate'th time and
+            # accumulated by the metrics, so only a block is kept in memory at a time
+            times = numpy.asarray(ts)
+            for start in range(0, len(times), CHUNK_SIZE):
+                block = times[start:start + CHUNK_SIZE]
+                values = solve(block)
+                # The first recorded time in the block
+                first = -(-start // decimate)
+                recorded = values[:nrows, first*decimate - start::decimate]
+                data[:, first:first + recorded.shape[1]] = recorded
+                for metric, state, signals in accumulators:
+                    metric.extend(state, block, *values[signals])
+                if progress:
+                    pbar.update(len(block))
+            engine.store()
+            finish_metrics()
+            self.time = ts[-1] + dt
+            return result
+
+        self.profile = Profile(memory=profile == 'memory') if profile else None
+        if closed_form and not profile and self.linear(sampled=True):
+            engine = CompiledDiagram(self, dt, method)
+            rows = [row for name in names + extra for row in _rows(engine.index[name])]
+            if engine.linear:
+                return solve_blocks(engine, lambda block: engine.solve(block, rows))
+            if engine.linear_between:
+                return solve_blocks(engine, lambda block: self.solve_samples(engine, block, rows))
+
+        if compiled == 'generated':
+            engine = self.compile(dt, method, names + extra)
+            return solve_blocks(engine, engine.run)
+
+        advance, select, finish = self.stepper(dt, names + extra, compiled, method, self.profile, ts)
+        with self.profile or contextlib.nullcontext():
+            for n, t in enumerate(ts):
+                values = select(advance(t, n))
+                if n % decimate == 0:
+                    data[:, n // decimate] = values[:nrows] if extra else values
+                for metric, state, signals in accumulators:
+                    metric.update(state, t, *[values[i] for i in signals])
+                if progress:
+                    pbar.update()
+        finish_metrics()
+        finish()
+        self.time = ts[-1] + dt
+        return result
+
+    @staticmethod
+    def solve_samples(engine, ts, rows):
+        """Advance a CompiledDiagram over the times ts, stepping only at the samples
+
+        The timesteps at which a sample is due are stepped through with
+        advance, and the stretches of timesteps between them are solved at
+        once (see CompiledDiagram.solve).
+
+        :return: array with a column of z[rows] for each time
+        """
+        values = numpy.empty((len(rows), len(ts)))
+        n = 0
+        while n < len(ts):
+            if ts[n] >= engine.next_event:
+                values[:, n] = engine.advance(ts[n])[rows]
+                n += 1
+            else:
+                stop = n + numpy.searchsorted(ts[n:], engine.next_event)
+                values[:, n:stop] = engine.solve(ts[n:stop], rows, between=True)
+                n = stop
+        return values
+
+    def simulate_sensitivity(self, ts, parameters, metrics=None, record=None, method='euler'):
+        """Simulate diagram along with the derivatives of the signals with respect to controller parameters
+
+        The sensitivities are advanced alongside the signals and states (see
+        SensitivityDiagram), so the gradients of the metrics come from a single
+        simulation instead of two or more extra ones per parameter for finite
+        differences, and are exact for the discretised simulation.
+
+        :param ts: iterable, timesteps to simulate. Note this should be equally spaced
+        :param parameters: list of (block name, parameter name), like [('Gc', 'Kc'), ('Gc', 'tau_i')]
+        :param metrics: dictionary with keys equal to names and values Metrics which have
+                        a gradient. Defaults to the IAE and ITAE of the error
+        :param record: iterable of signal names to record. All signals are recorded if None
+        :param method: integration method, 'euler' or 'zoh' (see Diagram.step)
+
+        Returns a SimulationResult with the values of the metrics in result.metrics,
+        their gradients as arrays with a value for each parameter in
+        result.gradients, and the derivatives of the recorded signals in
+        result.sensitivities, which maps each (block name, parameter name) to a
+        SimulationResult
+        """
+        if method not in ('euler', 'zoh'):
+            raise ValueError(f"Unsupported integration method '{method}', use 'euler' or 'zoh'")
+        if metrics is None:
+            metrics = {'IAE': IAE(), 'ITAE': ITAE()}
+        for name, metric in metrics.items():
+            if not isinstance(metric, Metric) or type(metric).gradient is Metric.gradient:
+                raise TypeError(f"The metric '{name}' has no gradient")
+        parameters = [tuple(parameter) for parameter in parameters]
+        blocks = {block.name: block for block in self.blocks}
+        for name, parameter in parameters:
+            if name not in blocks:
+                raise ValueError(f"There is no block called '{name}' in the diagram")
+
+        ts = numpy.asarray(ts)
+        dt = ts[1] - ts[0]
+        self.reset()
+        names = self.record_names(record)
+        probes = self.record_names(sorted({signal for metric in metrics.values() for signal in metric.signals}))
+        full = SimulationResult(names + [name for name in probes if name not in names], ts, sizes=self.sizes)
+        engine = SensitivityDiagram(self, dt, [(blocks[name], parameter) for name, parameter in parameters], method)
+
+        rows = [row for name in full.names for row in _rows(engine.index[name])]
+        table = InputTable(self, ts, engine.index)
+        input_functions = [(engine.index[name], function)
+                           for name, function in self.inputs.items() if name not in table.names]
+        # The rows of w with the recorded signals followed by their sensitivities, which
+        # are collected in a list and converted at the end, faster than writing columns
+        nparameters = len(parameters)
+        rows += [engine.nz + row*nparameters + k for row in rows for k in range(nparameters)]
+        values = []
+        for n, t in enumerate(ts):
+            z = engine.z
+            columns, m = table.at(n)
+            for i, column in columns:
+                z[i] = column[m]
+            engine.advance(t, input_functions)
+            values.append(engine.w[rows])
+        engine.store()
+        self.time = ts[-1] + dt
+        values = numpy.array(values).T
+        nrecorded = len(full.data)
+        full.data[:] = values[:nrecorded]
+        derivatives = values[nrecorded:].reshape(nrecorded, nparameters, len(ts)).transpose(1, 0, 2)
+
+        sensitivities = [SimulationResult(full.names, ts, data, self.sizes) for data in derivatives]
+        nrows = len([row for name in names for row in _rows(engine.index[name])])
+        result = SimulationResult(names, ts, full.data[:nrows], self.sizes)
+        result.metrics = {name: metric(full) for name, metric in metrics.items()}
+        result.gradients = {name: metric.gradient(full, sensitivities) for name, metric in metrics.items()}
+        result.sensitivities = {parameter: SimulationResult(names, ts, sensitivity.data[:nrows], self.sizes)
+                                for parameter, sensitivity in zip(parameters, sensitivities)}
+        return result
+
+    def iter_simulate(self, t_end, dt, chunk=1000, record=None, callback=None, stop=None,
+                      compiled=False, method='euler'):
+        """Simulate diagram in chunks, yielding the results as they are calculated
+
+        Only one chunk is kept in memory at a time, so this is suitable for very
+        long simulations. Times are calculated as n*dt, so they do not drift.
+
+        :param t_end: final time. The simulation starts at 0
+        :param dt: timestep
+        :param chunk: number of timesteps in each chunk
+        :param record: iterable of signal names to record. All signals are recorded if None
+        :param callback: function called with each chunk before it is yielded
+        :param stop: function of a chunk returning True to end the simulation after the chunk,
+                     or a boolean array over the times of the chunk. In that case the
+                     simulation ends at the first True value, which is the last value yielded
+        :param compiled: use a CompiledDiagram, or a GeneratedDiagram if 'generated'
+        :param method: integration method, 'euler' or 'zoh' (see Diagram.step)
+
+        Yields a SimulationResult for each chunk
+        """
+        if method not in METHODS or method == 'adaptive':
+            raise ValueError(f"Unsupported integration method '{method}', use 'euler' or 'zoh'")
+        self.reset()
+        names = self.record_names(record)
+        if compiled == 'generated':
+            engine = self.compile(dt, method, names)
+            finish = engine.store
+
+            def fill(result):
+                engine.run(result.t, result.data)
+        else:
+            advance, select, finish = self.stepper(dt, names, compiled, method)
+
+            def fill(result):
+                for k, t in enumerate(result.t):
+                    result.data[:, k] = select(advance(t))
+
+        nsteps = int(round(t_end/dt)) + 1
+        try:
+            for start in range(0, nsteps, chunk):
+                result = SimulationResult(names, numpy.arange(start, min(start + chunk, nsteps))*dt,
+                                          sizes=self.sizes)
+                fill(result)
+                self.time = result.t[-1] + dt
+                finished = False
+                if stop is not None:
+                    flags = numpy.asarray(stop(result))
+                    if flags.ndim == 0:
+                        finished = bool(flags)
+                    elif flags.any():
+                        end = numpy.argmax(flags) + 1
+                        result = SimulationResult(names, result.t[:end], result.data[:, :end], self.sizes)
+                        finished = True
+                if callback is not None:
+                    callback(result)
+                yield result
+                if finished:
+                    break
+        finally:
+            finish()
+
+    def linear(self, sampled=False):
+        """True if all the blocks are linear and undelayed, so a timestep is a linear map
+
+        :param sampled: also allow sampled blocks like DiscreteTF, so the timesteps
+                        between their samples, where their outputs are held, are a linear map
+        """
+        return all(isinstance(block, Zero)
+                   or (sampled and block.sample_time is not None)
+                   or (isinstance(block, LTI) and CompiledDiagram._linear(block) and not block.delay)
+                   for block in self.blocks)
+
+    def compile(self, dt, method='euler', record=None):
+        """Generate a function specialised to this diagram which advances it over many timesteps
+
+        :param dt: timestep
+        :param method: integration method, 'euler' or 'zoh' (see Diagram.step)
+        :param record: iterable of signal names to record. All signals are recorded if None
+
+        Returns a GeneratedDiagram
+        """
+        return GeneratedDiagram(self, dt, method, record)
+
+    def tabulate(self, ts, exclude=()):
+        """Values of the inputs which are InputSignals at all the times in ts
+
+        :param ts: times
+        :param exclude: names of inputs to leave out
+
+        Returns a dictionary with keys equal to input names and values arrays
+        of shape (len(ts),), or (len(ts), size) for vector signals
+        """
+        ts = numpy.asarray(ts, dtype=float)
+        table = {}
+        for name, function in self.inputs.items():
+            if isinstance(function, InputSignal) and name not in exclude:
+                values = numpy.asarray(function(ts), dtype=float)
+                size = self.sizes.get(name)
+                if size is not None:
+                    values = numpy.broadcast_to(values.reshape(len(ts), -1), (len(ts), size))
+                table[name] = values
+        return table
+
+    def record_names(self, record):
+        """List of signal names to record, checking that they exist"""
+        names = list(self.signals) if record is None else list(record)
+        for name in names:
+            if name not in self.signals:
+                raise ValueError(f"There is no signal called '{name}' in the diagram")
+        return names
+
+    def stepper(self, dt, names, compiled=False, method='euler', profile=None, ts=None):
+        """Prepare to advance the reset diagram with a fixed timestep
+
+        Returns functions advance(t, n), which advances the diagram and returns
+        all its values, select(values), which returns the values of the signals
+        in names, and finish(), which stores the final state of the simulation.
+        If a Profile is given, advance records the time taken by each part of the diagram in it.
+        If the times ts are given, the InputSignals are evaluated for blocks of them
+        beforehand (see InputTable), and advance must be called with the index n of t in ts.
+        Constant inputs are then set once, so they take no memory or time per step.
+        """
+        if ts is None or profile is not None:
+            held = {}
+            tabulated = []
+        else:
+            produced = set(self.sums) | {block.outputname for block in self.blocks}
+            held = {name: function for name, function in self.inputs.items()
+                    if isinstance(function, Constant) and name not in produced}
+            tabulated = InputTable(self, ts, {}, exclude=held).names
+        functions = [(name, function) for name, function in self.inputs.items()
+                     if name not in tabulated and name not in held]
+
+        if compiled:
+            engine = CompiledDiagram(self, dt, method)
+            for name, function in held.items():
+                engine.z[engine.index[name]] = function.constant
+            rows = [row for name in names for row in _rows(engine.index[name])]
+            if profile is not None:
+                return lambda t, n=None: engine.advance_profiled(t, profile), lambda z: z[rows], engine.store
+            if not tabulated and not held:
+                return lambda t, n=None: engine.advance(t), lambda z: z[rows], engine.store
+            table = InputTable(self, ts, engine.index, exclude=held)
+            input_functions = [(engine.index[name], function) for name, function in functions]
+
+            def advance(t, n=None):
+                z = engine.z
+                columns, m = table.at(n)
+                for i, column in columns:
+                    z[i] = column[m]
+                return engine.advance(t, input_functions)
+
+            return advance, lambda z: z[rows], engine.store
+
+        rows = [self.signal_names.index(name) for name in names]
+        index = {name: i for i, name in enumerate(self.signal_names)}
+        for name, function in held.items():
+            size = self.sizes.get(name)
+            self.values[index[name]] = function(0) if size is None else numpy.broadcast_to(function(0), size).copy()
+        input_program = [(index[name], function) for name, function in functions]
+        table = InputTable(self, ts, index, exclude=held)
+
+        def advance(t, n=None):
+            values = self.values
+            if tabulated:
+                columns, m = table.at(n)
+                for i, column in columns:
+                    values[i] = column[m]
+            return self.advance(t, dt, method, input_program)
+
+        if profile is not None:
+            def advance(t, n=None):
+                return self.advance_profiled(t, dt, method, profile)
+
+        def finish():
+            self.signals.update(zip(self.signal_names, self.values))
+
+        if any(name in self.sizes for name in names):
+            return advance, lambda values: numpy.hstack([values[i] for i in rows]), finish
+        return advance, lambda values: [values[i] for i in rows], finish
+
+    def evaluation_order(self, feedthrough):
+        """Order sums and blocks so that every signal is calculated before it is used
+
+        :param feedthrough: function(block) returning True if the output of the
+                            block depends on its current input
+
+        Returns a list of ('sum', output) and ('block', block) entries.
+        Blocks without feedthrough only depend on their states, so they come first.
+        Raises ValueError if there is an algebraic loop.
+        """
+        nodes = [('block', block) for block in self.blocks if not feedthrough(block)]
+        nodes += [('sum', output) for output in self.sums]
+        nodes += [('block', block) for block in self.blocks if feedthrough(block)]
+
+        producers = {}
+        for node in nodes:
+            kind, item = node
+            producers[item if kind == 'sum' else item.outputname] = node
+
+        def dependencies(node):
+            kind, item = node
+            if kind == 'sum':
+                names = [s[1:] for s in self.sums[item]]
+            elif feedthrough(item):
+                names = [item.inputname]
+            else:
+                names = []
+            return [producers[name] for name in names
+                    if name in producers and name not in self.inputs]
+
+        order = []
+        visiting = []
+        done = set()
+
+        def visit(node):
+            if node in done:
+                return
+            if node in visiting:
+                loop = visiting[visiting.index(node):]
+                names = [item if kind == 'sum' else item.name for kind, item in loop]
+                raise ValueError(f"Algebraic loop through {' → '.join(names)}")
+            visiting.append(node)
+            for dependency in dependencies(node):
+                visit(dependency)
+            visiting.pop()
+            done.add(node)
+            order.append(node)
+
+        for node in nodes:
+            visit(node)
+        return order
 
     def __repr__(self):
         return '\n'.join(str(b) for b in self.blocks)
 
 
-# Input functions
-def step(initial=0, starttime=0, size=1):
-    """Return a function which can be used to simulate a step"""
-    def stepfunction(t):
-        if t < starttime:
-            return initial
+class InputTable:
+    """Values of the InputSignals of a diagram over the times ts, tabulated in blocks
+
+    The inputs are evaluated for CHUNK_SIZE times at a time (see Diagram.tabulate)
+    when they are first needed, so the memory does not grow with the length of
+    the simulation. Scalar columns are kept as lists of floats, which are faster
+    to calculate with than numpy scalars.
+    """
+    def __init__(self, diagram, ts, index, exclude=()):
+        """:param diagram: Diagram with the inputs
+           :param ts: times of the simulation
+           :param index: dictionary mapping input names to their index in the values
+           :param exclude: names of inputs to leave out
+        """
+        self.diagram = diagram
+        self.ts = ts
+        self.index = index
+        self.exclude = exclude
+        self.names = [name for name, function in diagram.inputs.items()
+                      if isinstance(function, InputSignal) and name not in exclude]
+        self.start = self.stop = 0
+        self.columns = []
+
+    def at(self, n):
+        """Return (columns, m), where columns is a list of (index, column) for the inputs
+        and m is the position of ts[n] in the columns"""
+        if not self.start <= n < self.stop:
+            table = self.diagram.tabulate(self.ts[n:n + CHUNK_SIZE], self.exclude)
+            self.columns = [(self.index[name], column.tolist() if column.ndim == 1 else column)
+                            for name, column in table.items()]
+            self.start, self.stop = n, n + CHUNK_SIZE
+        return self.columns, n - self.start
+
+
+def _sparse_enough(size, nonzero):
+    """True if a matrix with size elements, of which nonzero are nonzero, is stored
+    as a scipy.sparse array (see SPARSE_SIZE)"""
+    return size >= SPARSE_SIZE**2 and nonzero <= SPARSE_FILL*size
+
+
+def _dense(Phi):
+    """Phi as a numpy array, if it is a RowUpdate"""
+    return Phi.toarray() if isinstance(Phi, RowUpdate) else Phi
+
+
+def _rows(index):
+    """Rows of an index which is an integer for a scalar signal or a slice for a vector signal"""
+    return [index] if isinstance(index, int) else list(range(index.start, index.stop))
+
+
+class SimulationResult(Mapping):
+    """Recorded signals of a simulation
+
+    The values are stored in a single preallocated array with one contiguous
+    row per signal, or a block of rows for a vector signal. Indexing with a
+    signal name returns a view of that row, or an array of shape
+    (size, len(t)) for vector signals, so no data is copied.
+
+    Results can also be stored on disk with create, in which case the array is
+    a memory-mapped .npy file which is written while the simulation runs.
+    Stored results are reopened with open without reading the data, so runs
+    larger than memory can be sliced and plotted.
+
+    :attribute names: list of recorded signal names
+    :attribute t: times at which the signals were recorded
+    :attribute data: array with the rows of all the signals and len(t) columns
+    :attribute sizes: dictionary of sizes of vector signals (see Diagram.signal_sizes)
+    :attribute metrics: dictionary of the values of the metrics accumulated during the
+                        simulation (see Diagram.simulate)
+    :attribute gradients: dictionary of the derivatives of the metrics with respect to
+                          parameters (see Diagram.simulate_sensitivity)
+    :attribute sensitivities: dictionary of SimulationResults of the derivatives of the
+                              signals with respect to parameters (see Diagram.simulate_sensitivity)
+    """
+    def __init__(self, names, t, data=None, sizes=None):
+        self.names = list(names)
+        self.t = t
+        self.sizes = {name: size for name, size in (sizes or {}).items() if name in self.names}
+        self.index = {}
+        nrows = 0
+        for name in self.names:
+            size = self.sizes.get(name)
+            self.index[name] = nrows if size is None else slice(nrows, nrows + size)
+            nrows += 1 if size is None else size
+        if data is None:
+            data = numpy.empty((nrows, len(t)))
+        self.data = data
+        self.metrics = {}
+        self.gradients = {}
+        self.sensitivities = {}
+
+    @classmethod
+    def create(cls, path, names, t, sizes=None):
+        """Create a result stored in the directory path
+
+        The directory contains t.npy with the times, data.npy with the signals,
+        which is memory mapped and filled in as the simulation runs, and
+        manifest.json with the names and sizes of the signals.
+
+        :param path: directory, which is created if needed. Existing results are overwritten
+        :param names: list of signal names
+        :param t: times
+        :param sizes: dictionary of sizes of vector signals
+        """
+        names = list(names)
+        sizes = {name: size for name, size in (sizes or {}).items() if name in names}
+        os.makedirs(path, exist_ok=True)
+        numpy.save(os.path.join(path, 't.npy'), numpy.asarray(t, dtype=float))
+        nrows = sum(sizes.get(name, 1) for name in names)
+        data = numpy.lib.format.open_memmap(os.path.join(path, 'data.npy'), mode='w+',
+                                            dtype=float, shape=(nrows, len(t)))
+        with open(os.path.join(path, 'manifest.json'), 'w') as f:
+            json.dump({'format': 1, 'names': names, 'sizes': sizes}, f, indent=2)
+        return cls(names, numpy.load(os.path.join(path, 't.npy'), mmap_mode='r'), data, sizes)
+
+    @classmethod
+    def open(cls, path, mode='r'):
+        """Open a result stored with create, memory mapping the data instead of reading it
+
+        :param path: directory of the result
+        :param mode: mmap_mode for numpy.load, 'r' for read only or 'r+' to allow changes
+        """
+        with open(os.path.join(path, 'manifest.json')) as f:
+            manifest = json.load(f)
+        t = numpy.load(os.path.join(path, 't.npy'), mmap_mode=mode)
+        data = numpy.load(os.path.join(path, 'data.npy'), mmap_mode=mode)
+        return cls(manifest['names'], t, data, manifest['sizes'])
+
+    def flush(self):
+        """Write any changes to the data of a stored result to disk"""
+        if isinstance(self.data, numpy.memmap):
+            self.data.flush()
+
+    def __getitem__(self, name):
+        return self.data[self.index[name]]
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({len(self.names)} signals, {len(self.t)} times)"
+
+
+class Profile:
+    """Time, calls and memory used by each part of a diagram during a simulation
+
+    Collected by Diagram.simulate(profile=True). Each entry is identified by
+    its kind, 'input', 'sum', 'block' or 'integrate' (or 'matrix' for the
+    matrix products of a CompiledDiagram, named by their position in the
+    step), and the name of the signal or block.
+
+    Example
+
+    >>> diagram.simulate(ts, profile=True)
+    >>> print(diagram.profile.report(10))
+    """
+    def __init__(self, memory=False):
+        """:param memory: also record the peak memory allocated in each call with tracemalloc"""
+        self.memory = memory
+        self.entries = {}
+        self.tracing = False
+
+    def __enter__(self):
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.tracing = True
+        return self
+
+    def __exit__(self, *exception):
+        if self.tracing:
+            tracemalloc.stop()
+            self.tracing = False
+
+    def call(self, kind, name, function, *args):
+        """Call function(*args) and add the time taken and memory allocated to the entry for kind and name"""
+        if self.memory:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        result = function(*args)
+        elapsed = time.perf_counter() - start
+        entry = self.entries.get((kind, name))
+        if entry is None:
+            entry = self.entries[(kind, name)] = [0, 0.0, 0]
+        entry[0] += 1
+        entry[1] += elapsed
+        if self.memory:
+            entry[2] += tracemalloc.get_traced_memory()[1] - before
+        return result
+
+    def as_dict(self):
+        """Profile as a dictionary with the total time and a list of entries sorted by decreasing time
+
+        Each entry is a dictionary with keys kind, name, calls, time (in seconds) and allocated
+        (peak bytes allocated, summed over the calls, or None if memory was not recorded).
+        """
+        entries = [{'kind': kind, 'name': name, 'calls': calls, 'time': elapsed,
+                    'allocated': allocated if self.memory else None}
+                   for (kind, name), (calls, elapsed, allocated) in self.entries.items()]
+        entries.sort(key=lambda entry: entry['time'], reverse=True)
+        return {'total_time': sum(entry['time'] for entry in entries), 'entries': entries}
+
+    def report(self, limit=None):
+        """Table of the entries sorted by decreasing time
+
+        :param limit: number of entries to show, all if None
+        """
+        profile = self.as_dict()
+        total = profile['total_time'] or 1
+        lines = [f"{'kind':<12} {'name':<20} {'calls':>8} {'time [s]':>10} {'per call [µs]':>14} {'share':>7}"
+                 + (f" {'allocated [B]':>14}" if self.memory else '')]
+        for entry in profile['entries'][:limit]:
+            line = (f"{entry['kind']:<12} {str(entry['name']):<20} {entry['calls']:>8} {entry['time']:>10.4f} "
+                    f"{1e6*entry['time']/entry['calls']:>14.2f} {entry['time']/total:>7.1%}")
+            if self.memory:
+                line += f" {entry['allocated']:>14}"
+            lines.append(line)
+        return '\n'.join(lines)
+
+    def __str__(self):
+        return self.report()
+
+
+class RowUpdate:
+    """Linear map z -> Phi z stored as the rows of Phi which differ from the identity
+
+    The rows are kept in a scipy.sparse array if there are enough of them and
+    they are sparse enough (see SPARSE_SIZE), so both the memory and the cost
+    of dot grow with the number of nonzero elements in the changed rows
+    instead of with the size of Phi.
+    """
+    __slots__ = ('rows', 'matrix', 'shape')
+
+    def __init__(self, Phi, rows=None):
+        """:param Phi: square matrix
+           :param rows: rows of Phi which differ from the identity, found if None
+        """
+        self.shape = Phi.shape
+        if rows is None:
+            rows = numpy.flatnonzero(numpy.any(Phi != numpy.eye(len(Phi)), axis=1))
+        self.rows = numpy.asarray(rows, dtype=int)
+        matrix = Phi[self.rows]
+        if _sparse_enough(matrix.size, numpy.count_nonzero(matrix)):
+            matrix = scipy.sparse.csr_array(matrix)
+        self.matrix = matrix
+
+    def dot(self, z):
+        """Phi z, which is written into z, since only a few rows usually change"""
+        z[self.rows] = self.matrix.dot(z)
+        return z
+
+    def toarray(self):
+        Phi = numpy.eye(self.shape[0])
+        Phi[self.rows] = self.matrix.toarray() if scipy.sparse.issparse(self.matrix) else self.matrix
+        return Phi
+
+
+class CompiledDiagram:
+    """Whole-diagram state space form of a Diagram for a fixed timestep
+
+    The signals of the diagram and the states of all the linear blocks are
+    stacked into one vector z. Each operation in Diagram.step (evaluating a sum,
+    calculating a block output, integrating a block state) replaces some rows of
+    z by a linear combination of z, so consecutive linear operations are
+    composed into a single matrix when the diagram is compiled. Blocks which
+    are not linear (AlgebraicEquation, Deadtime, DiscreteTF, Controllers in
+    manual and custom blocks) are called out to between these matrix products
+    in the same order as Diagram.step would use them, so the results match
+    the interpreted simulation. Linear operations which do not depend on the
+    calls before them are composed into the matrix ahead of them, so the
+    calls share as few matrix products as possible.
+
+    Sampled blocks like DiscreteTF hold their outputs between samples, so
+    timesteps without a sample use self.between, where those blocks are left
+    out and the operations around them are composed into fewer matrices.
+    When that leaves a single matrix, the timesteps between samples can be
+    solved at once (see solve and Diagram.schedule).
+
+    The matrices mostly leave z unchanged, so they are stored as the rows
+    which change (see RowUpdate), in scipy.sparse arrays for large networks of
+    blocks like many tanks in series (see SPARSE_SIZE). The cost of a step
+    then grows with the number of connections instead of the square of the
+    number of signals and states.
+    """
+    # (block, parameter) pairs which compose differentiates with respect to
+    parameters = ()
+
+    def __init__(self, diagram, dt, method='euler'):
+        """:param diagram: Diagram to compile
+           :param dt: timestep which will be used
+           :param method: integration method for the LTI blocks, 'euler' or 'zoh'
+        """
+        self.diagram = diagram
+        self.dt = dt
+        self.method = method
+
+        self.signal_names = list(diagram.signals)
+        self.signal_names += [s for s in diagram.inputs if s not in diagram.signals]
+        # Scalar signals use a row of z and vector signals a slice
+        index = {}
+        nz = 0
+        for name in self.signal_names:
+            size = diagram.sizes.get(name)
+            index[name] = nz if size is None else slice(nz, nz + size)
+            nz += 1 if size is None else size
+        self.index = dict(index)
+        self.nsignals = nz
+
+        # Delayed LTI blocks need a hidden signal for the undelayed output
+        self.hidden = {}
+        for block in diagram.blocks:
+            if isinstance(block, LTI) and block.delay and self._linear(block):
+                self.hidden[block] = index[block] = nz
+                nz += 1
+
+        self.states = {}
+        for block in diagram.blocks:
+            if isinstance(block, LTI) and self._linear(block):
+                nx = block.realisation.A.shape[0]
+                self.states[block] = slice(nz, nz + nx)
+                nz += nx
+
+        self.input_functions = [(index[signal], function) for signal, function in diagram.inputs.items()]
+        self.outputs = [(index[name], name) for name in self.signal_names]
+        # Names for the delays of LTI blocks when profiling
+        self.labels = {block.delay: f'{block.name} delay' for block in self.hidden}
+
+        self.segments, self.segment_derivatives = self.compose(index, nz, sampled=True)
+        self.between, self.between_derivatives = self.compose(index, nz, sampled=False)
+        # Recurrences for solve, calculated when first needed
+        self.recurrences = {}
+        self.next_event = diagram.schedule()
+
+        self.z = numpy.zeros(nz)
+        for i, name in self.outputs:
+            self.z[i] = diagram.signals[name]
+        for block, x in self.states.items():
+            self.z[x] = block.x.ravel()
+
+    def compose(self, index, nz, sampled=True):
+        """Compose the operations of a timestep into a list of segments (Phi, callouts)
+
+        The segments are applied as z = Phi z followed by the callouts in order.
+        Phi is None where there are no linear operations between callouts.
+        Callouts are (block, input, output) and integrate the block if output is None.
+
+        The derivatives dPhi of each Phi with respect to the parameters in
+        self.parameters are composed alongside, by the product rule. They are
+        returned as a list with a matrix for each segment, with the rows of
+        dPhi for all the parameters interleaved (see SensitivityDiagram), or
+        None where Phi does not depend on the parameters.
+
+        :param index: dictionary of rows of z for each signal and hidden signal
+        :param nz: number of rows of z
+        :param sampled: evaluate the sampled blocks, otherwise their outputs are held
+        :return segments, derivatives:
+        """
+        diagram = self.diagram
+        segments = []
+        derivatives = []
+        identity = numpy.eye(nz)
+        Phi = identity.copy()
+        dPhi = numpy.zeros((len(self.parameters), nz, nz))
+        # Rows of Phi and dPhi written since the last segment. Only these can differ
+        # from the identity, so only they are compared, stored and reset
+        changed = set()
+        # Callouts which follow Phi in the current segment, and the rows they read and
+        # write. Linear operations which do not use those rows are composed into Phi
+        # ahead of them, so for example the Deadtime blocks of a chain of delayed
+        # tanks share one segment instead of each needing their own
+        callouts = []
+        inputs = set()
+        outputs = set()
+        partials = {}
+        for k, (block, parameter) in enumerate(self.parameters):
+            partials.setdefault(block, []).append((k, block.realisation_derivatives(parameter)))
+
+        def finish():
+            rows = sorted(changed)
+            derivatives.append(self.derivative_matrix(dPhi) if dPhi[:, rows].any() else None)
+            written = [row for row in rows if not numpy.array_equal(Phi[row], identity[row])]
+            segments.append((self.matrix(Phi, written) if written else None, list(callouts)))
+            Phi[rows] = identity[rows]
+            dPhi[:, rows] = 0
+            for pending in (changed, callouts, inputs, outputs):
+                pending.clear()
+
+        def linear(reads, writes):
+            # Called before each linear operation, which must follow the callouts if
+            # it reads their outputs, or writes their inputs or outputs
+            if outputs.intersection(reads) or outputs.union(inputs).intersection(writes):
+                finish()
+            changed.update(writes)
+
+        def callout(block, i, o):
+            callouts.append((block, i, o))
+            inputs.update(_rows(i))
+            if o is not None:
+                outputs.update(_rows(o))
+
+        for kind, block in diagram.order:
+            if kind == 'sum':
+                output = block
+                linear([row for s in diagram.sums[output] for row in _rows(index[s[1:]])], _rows(index[output]))
+                Phi[index[output]] = sum(int(s[0]+'1')*Phi[index[s[1:]]] for s in diagram.sums[output])
+                dPhi[:, index[output]] = sum(int(s[0]+'1')*dPhi[:, index[s[1:]]] for s in diagram.sums[output])
+                continue
+            u = index[block.inputname]
+            y = index[block.outputname]
+            if isinstance(block, Zero):
+                linear([], _rows(y))
+                Phi[y] = 0
+                dPhi[:, y] = 0
+            elif block in self.states:
+                x = self.states[block]
+                C, D = block.realisation.C, block.realisation.D
+                # Strictly proper blocks do not read their input
+                proper = D.any() or any(dD.any() for k, (dA, dB, dC, dD) in partials.get(block, []))
+                reads = _rows(x) + (_rows(u) if proper else [])
+                linear(reads, [self.hidden[block]] if block.delay else _rows(y))
+                output = C.dot(Phi[x]) + D.dot(Phi[_rows(u)])
+                doutput = numpy.matmul(C, dPhi[:, x]) + numpy.matmul(D, dPhi[:, _rows(u)])
+                for k, (dA, dB, dC, dD) in partials.get(block, []):
+                    doutput[k] += dC.dot(Phi[x]) + dD.dot(Phi[_rows(u)])
+                if block.delay:
+                    Phi[self.hidden[block]] = output[0]
+                    dPhi[:, self.hidden[block]] = doutput[:, 0]
+                    callout(block.delay, self.hidden[block], y)
+                else:
+                    Phi[_rows(y)] = output
+                    dPhi[:, _rows(y)] = doutput
+            elif sampled or block.sample_time is None:
+                callout(block, u, y)
+
+        # All the states are integrated once the signals are known
+        for block, x in self.states.items():
+            A, B = block.realisation.A, block.realisation.B
+            if self.method == 'zoh':
+                Ad, Bd = block.discretise(self.dt)
+            else:
+                Ad, Bd = numpy.eye(len(block.x)) + A*self.dt, B*self.dt
+            u = _rows(index[block.inputname])
+            linear(_rows(x) + u, _rows(x))
+            dPhi[:, x] = numpy.matmul(Ad, dPhi[:, x]) + numpy.matmul(Bd, dPhi[:, u])
+            for k, (dA, dB, dC, dD) in partials.get(block, []):
+                if self.method == 'zoh':
+                    dAd, dBd = block.realisation.discretisation_derivative(self.dt, dA, dB)
+                else:
+                    dAd, dBd = dA*self.dt, dB*self.dt
+                dPhi[k, x] += dAd.dot(Phi[x]) + dBd.dot(Phi[u])
+            Phi[x] = Ad.dot(Phi[x]) + Bd.dot(Phi[u])
+        finish()
+        for block in diagram.blocks:
+            if (block not in self.states and block.sample_time is None
+                    and not isinstance(block, (Zero, AlgebraicEquation, Deadtime))):
+                segments[-1][1].append((block, index[block.inputname], None))
+        return segments, derivatives
+
+    @staticmethod
+    def matrix(Phi, rows):
+        """Phi as a RowUpdate of the rows which differ from the identity"""
+        return RowUpdate(Phi, rows)
+
+    @staticmethod
+    def derivative_matrix(dPhi):
+        """Matrix G with G z = [dPhi[0] z, dPhi[1] z, ...] with the rows interleaved
+
+        The product then has the shape of the sensitivities when reshaped to
+        (nz, number of parameters). It is sparse for large diagrams, since
+        only the rows and columns near the parameterised blocks are nonzero.
+        """
+        nparameters, nz, _ = dPhi.shape
+        G = numpy.moveaxis(dPhi, 0, 1).reshape(nz*nparameters, nz)
+        if _sparse_enough(G.size, numpy.count_nonzero(G)):
+            return scipy.sparse.csr_array(G)
+        return G
+
+    @property
+    def linear(self):
+        """True if a timestep is a single matrix product, so the diagram can be solved in closed form"""
+        return not self.diagram.sampled and self.linear_between
+
+    @property
+    def linear_between(self):
+        """True if a timestep between samples is a single matrix product, so the
+        timesteps between samples can be solved in closed form"""
+        return not any(callouts for Phi, callouts in self.between)
+
+    def recurrence(self, between=False):
+        """The recurrence solved by solve, as (A, B, states, T, Q)
+
+        With the rows of the states in z as x, z[n] = A x[n-1] + B u[n], and
+        T, Q are the Schur decomposition of A[states]. These only depend on
+        the timestep, so they are calculated once and reused for every block
+        of times solved.
+
+        :param between: the recurrence of the timesteps between samples
+        """
+        if between in self.recurrences:
+            return self.recurrences[between]
+        nz = len(self.z)
+        Phi = (self.between if between else self.segments)[0][0]
+        M = _dense(Phi) if Phi is not None else numpy.eye(nz)
+        inputs = [row for i, function in self.input_functions for row in _rows(i)]
+        P = numpy.eye(nz)
+        P[inputs, inputs] = 0
+        A = M.dot(P)
+        states = numpy.flatnonzero(numpy.any(A != 0, axis=0))
+        T, Q = scipy.linalg.schur(A[numpy.ix_(states, states)], output='complex') if len(states) else (None, None)
+        self.recurrences[between] = A[:, states], M[:, inputs], states, T, Q
+        return self.recurrences[between]
+
+    def solve(self, ts, rows=None, between=False):
+        """Calculate z for all the times in ts at once, for a linear diagram
+
+        A timestep is the linear recurrence z[n] = M (P z[n-1] + E u[n]), where
+        P clears the rows of the inputs, E inserts the input values u[n] and M
+        is the matrix of the step. Only the rows of z with nonzero columns in MP
+        (the states) carry over from one step to the next, so with those as x,
+        x[n] = A x[n-1] + B u[n]. This is transformed to upper triangular form
+        with a complex Schur decomposition, which is well conditioned even for
+        repeated poles. Each transformed state is then a first order recurrence
+        driven by the states after it, which is solved for all the times with
+        scipy.signal.lfilter, starting from the last state.
+
+        The compiled diagram is left at the last time, like after advance, so
+        long simulations can be solved in successive blocks of times.
+
+        Diagrams with sampled blocks can be solved between their samples with
+        between=True, where the outputs of those blocks are held like other
+        states. The times must then all be before the next sample is due.
+
+        :param ts: times, which must be spaced by the timestep of the compiled diagram
+        :param rows: rows of z to return, all of them if None
+        :param between: solve the timesteps between samples
+        :return: array with a column of z[rows] for each time
+        """
+        if not (self.linear_between if between else self.linear):
+            raise ValueError("Only linear diagrams can be solved in closed form")
+        N = len(ts)
+        A, B, states, T, Q = self.recurrence(between)
+        table = self.diagram.tabulate(ts)
+        U = numpy.zeros((B.shape[1], N))
+        row = 0
+        for name, (i, function) in zip(self.diagram.inputs, self.input_functions):
+            if name in table:
+                values = table[name].reshape(N, -1).T
+            else:
+                values = numpy.array([function(t) for t in ts], dtype=float).reshape(N, -1).T
+            U[row:row + len(values)] = values
+            row += len(values)
+
+        X = numpy.zeros((len(states), N))
+        if len(states):
+            forcing = Q.conj().T.dot(B[states].dot(U[:, :-1]))
+            W = numpy.zeros((len(states), N), dtype=complex)
+            W[:, 0] = Q.conj().T.dot(self.z[states])
+            for i in reversed(range(len(states))):
+                f = forcing[i] + T[i, i + 1:].dot(W[i + 1:, :-1])
+                W[i, 1:], _ = scipy.signal.lfilter([1], [1, -T[i, i]], f, zi=[T[i, i]*W[i, 0]])
+            X = Q.dot(W).real
+
+        self.z = A.dot(X[:, -1]) + B.dot(U[:, -1])
+        if rows is None:
+            return A.dot(X) + B.dot(U)
+        return A[rows].dot(X) + B[rows].dot(U)
+
+    @staticmethod
+    def _linear(block):
+        if isinstance(block, MIMO):
+            return not block.delays
+        return not isinstance(block, Controller) or block.automatic
+
+    def step(self, t, dt):
+        """Advance the compiled diagram by one timestep
+
+        Returns dictionary of signal values, like Diagram.step
+        """
+        z = self.advance(t)
+        return {name: z[i] for i, name in self.outputs}
+
+    def advance(self, t, input_functions=None):
+        """Advance the compiled diagram by one timestep and return z
+
+        :param input_functions: list of (index, function) of the inputs to evaluate,
+                                all of them if None. The others must already be set in self.z
+        """
+        dt = self.dt
+        z = self.z
+        for i, function in self.input_functions if input_functions is None else input_functions:
+            z[i] = function(t)
+        sample = t >= self.next_event
+        for Phi, callouts in self.segments if sample else self.between:
+            if Phi is not None:
+                z = Phi.dot(z)
+            for block, i, o in callouts:
+                if o is not None:
+                    z[o] = block.change_input(t, z[i])
+                elif self.method == 'zoh' and isinstance(block, LTI):
+                    block.integrate(z[i], dt)
+                else:
+                    block.euler(z[i], dt)
+        if sample:
+            self.next_event = self.diagram.schedule()
+        self.z = z
+        return z
+
+    def advance_profiled(self, t, profile):
+        """Advance the compiled diagram like advance, recording the time taken by each part in a Profile"""
+        dt = self.dt
+        z = self.z
+        for name, (i, function) in zip(self.diagram.inputs, self.input_functions):
+            z[i] = profile.call('input', name, function, t)
+        sample = t >= self.next_event
+        if sample or not self.diagram.sampled:
+            segments, label = self.segments, 'segment {}'
         else:
-            return initial + size
-    return stepfunction
+            segments, label = self.between, 'segment {} held'
+        for k, (Phi, callouts) in enumerate(segments):
+            if Phi is not None:
+                z = profile.call('matrix', label.format(k), Phi.dot, z)
+            for block, i, o in callouts:
+                name = self.labels.get(block, block.name)
+                if o is not None:
+                    z[o] = profile.call('block', name, block.change_input, t, z[i])
+                elif self.method == 'zoh' and isinstance(block, LTI):
+                    profile.call('integrate', name, block.integrate, z[i], dt)
+                else:
+                    profile.call('integrate', name, block.euler, z[i], dt)
+        if sample:
+            self.next_event = self.diagram.schedule()
+        self.z = z
+        return z
+
+    def store(self):
+        """Copy the signals and the states and outputs of the linear blocks back to the diagram"""
+        z = self.z
+        self.diagram.signals.update((name, z[i].copy()) for i, name in self.outputs)
+        for block, x in self.states.items():
+            block.change_state(z[x].reshape(-1, 1))
+            block.y = block.output = z[self.index[block.outputname]].copy()
+
+
+class SensitivityDiagram(CompiledDiagram):
+    """Compiled diagram which also advances the derivatives of z with respect to controller parameters
+
+    With z[n+1] = Phi(p) z[n] for a segment of a timestep, the sensitivities
+    S = dz/dp follow S[n+1] = Phi S[n] + (dPhi/dp) z[n], where dPhi/dp is
+    composed from the derivatives of the realisation matrices of the
+    controller (see Controller.realisation_derivatives and compose). This is
+    the exact derivative of the discretised simulation, so it is consistent
+    with the simulated values for any timestep, unlike finite differences.
+
+    Both are advanced together as the vector w = [z, S.ravel()], so each
+    segment is a single product with the matrix [[Phi, 0], [dPhi/dp, Phi]],
+    with Phi repeated for every parameter. Deadtime and DiscreteTF blocks are
+    linear in their inputs, so the sensitivities pass through copies of them.
+    Other blocks which are called out to are not supported. The initial state
+    is taken to be independent of the parameters, so S starts at zero.
+
+    :attribute S: array of shape (len(z), number of parameters), a view of w
+    """
+    def __init__(self, diagram, dt, parameters, method='euler'):
+        """:param diagram: Diagram to compile
+           :param dt: timestep which will be used
+           :param parameters: list of (block, parameter name) to differentiate with respect to,
+                              where the blocks are Controllers (see Controller.parameters)
+           :param method: integration method for the LTI blocks, 'euler' or 'zoh'
+        """
+        for block, parameter in parameters:
+            if not isinstance(block, Controller) or not self._linear(block):
+                raise ValueError(f"Sensitivities can only be calculated for the parameters of "
+                                 f"automatic controllers, not for '{block.name}'")
+        self.parameters = list(parameters)
+        super().__init__(diagram, dt, method)
+
+        self.copies = {}
+        for segments in (self.segments, self.between):
+            for Phi, callouts in segments:
+                for block, i, o in callouts:
+                    if o is None or not isinstance(block, (Deadtime, DiscreteTF)):
+                        name = self.labels.get(block, block.name)
+                        raise ValueError(f"Sensitivities cannot be calculated through the block '{name}'")
+                    if block not in self.copies:
+                        self.copies[block] = [copy.deepcopy(block) for parameter in self.parameters]
+                        for c in self.copies[block]:
+                            c.reset()
+
+        self.nz = len(self.z)
+        self.augmented = [(self.augment(Phi, G), callouts)
+                          for (Phi, callouts), G in zip(self.segments, self.segment_derivatives)]
+        self.augmented_between = [(self.augment(Phi, G), callouts)
+                                  for (Phi, callouts), G in zip(self.between, self.between_derivatives)]
+        self._unpack(numpy.concatenate([self.z, numpy.zeros(self.nz*len(self.parameters))]))
+
+    def augment(self, Phi, G):
+        """Matrix [[Phi, 0], [G, Phi for each parameter]] which advances w, or None for the identity"""
+        if Phi is None and G is None:
+            return None
+        nz = self.nz
+        nparameters = len(self.parameters)
+        Phi = numpy.eye(nz) if Phi is None else _dense(Phi)
+        G = numpy.zeros((nz*nparameters, nz)) if G is None else G
+        # The rows of S.ravel() are interleaved like the rows of G
+        nonzero = (1 + nparameters)*numpy.count_nonzero(Phi)
+        nonzero += G.nnz if scipy.sparse.issparse(G) else numpy.count_nonzero(G)
+        if _sparse_enough((nz*(1 + nparameters))**2, nonzero):
+            Phi = scipy.sparse.csr_array(Phi)
+            repeated = scipy.sparse.kron(Phi, scipy.sparse.eye_array(nparameters))
+            return scipy.sparse.block_array([[Phi, None], [scipy.sparse.csr_array(G), repeated]], format='csr')
+        G = G.toarray() if scipy.sparse.issparse(G) else G
+        return numpy.block([[Phi, numpy.zeros((nz, nz*nparameters))],
+                            [G, numpy.kron(Phi, numpy.eye(nparameters))]])
+
+    def _unpack(self, w):
+        # z and S are views of w, so writing to them changes w
+        self.w = w
+        self.z = w[:self.nz]
+        self.S = w[self.nz:].reshape(self.nz, len(self.parameters))
+
+    def advance(self, t, input_functions=None):
+        """Advance the compiled diagram and the sensitivities by one timestep and return z
+
+        The sensitivities are left in self.S
+        """
+        w = self.w
+        z, S = self.z, self.S
+        for i, function in self.input_functions if input_functions is None else input_functions:
+            z[i] = function(t)
+        sample = t >= self.next_event
+        for M, callouts in self.augmented if sample else self.augmented_between:
+            if M is not None:
+                w = M.dot(w)
+            if callouts:
+                self._unpack(w)
+                z, S = self.z, self.S
+            for block, i, o in callouts:
+                z[o] = block.change_input(t, z[i])
+                for k, c in enumerate(self.copies[block]):
+                    S[o, k] = c.change_input(t, S[i, k])
+        if sample:
+            self.next_event = self.diagram.schedule()
+        self._unpack(w)
+        return self.z
+
+
+@functools.lru_cache(maxsize=64)
+def compile_generated(source, key):
+    """Compile the source of a GeneratedDiagram and return its make function
+
+    The functions are kept in a least recently used cache by their source, so
+    a long parameter study does not keep every structure it has generated.
+
+    :param key: hash of the source, which names the code in tracebacks
+    """
+    namespace = {'numpy': numpy}
+    exec(compile(source, f'<blocksim {key[:12]}>', 'exec'), namespace)
+    return namespace['make']
+
+
+class GeneratedDiagram:
+    """Python function generated for a particular Diagram, which advances it over many timesteps
+
+    The source of a function is written for the diagram, with its signals and
+    the states of its LTI blocks as local variables, the sums written out as
+    expressions and the realisations of the LTI blocks written out as scalar
+    arithmetic (or matrix products for more than two states). Other blocks,
+    and delayed and manual LTI blocks, are called in the same order as
+    Diagram.step would, so the results are the same, but without the overhead
+    of interpreting the program of the diagram at every step.
+
+    The numbers and blocks are passed to the generated code as arguments, so
+    the source only depends on the structure of the diagram. The compiled
+    code is kept in a least recently used cache (see compile_generated), so
+    diagrams which only differ in their parameters, like the points of a
+    sweep, are only compiled once.
+
+    Example
 
+    >>> engine = diagram.compile(dt)
+    >>> print(engine.source)
+    """
+    def __init__(self, diagram, dt, method='euler', record=None):
+        """:param diagram: Diagram to generate the function for
+           :param dt: timestep which will be used
+           :param method: integration method, 'euler' or 'zoh' (see Diagram.step)
+           :param record: iterable of signal names to record. All signals are recorded if None
+        """
+        if method not in ('euler', 'zoh'):
+            raise ValueError(f"Unsupported integration method '{method}', use 'euler' or 'zoh'")
+        self.diagram = diagram
+        self.dt = dt
+        self.method = method
+        self.names = diagram.record_names(record)
+
+        self.blocks = []
+        self.constants = []
+        self.functions = []
+        self.tabulated = []
+        # Local variable names of the states of the inlined LTI blocks
+        self.states = {}
+        index = {name: i for i, name in enumerate(diagram.signal_names)}
+
+        def signal(name):
+            return f's{index[name]}'
+
+        def bind(items, prefix, item):
+            items.append(item)
+            return f'{prefix}{len(items) - 1}'
+
+        def constant(value):
+            return bind(self.constants, 'c', value)
+
+        def block_name(block):
+            return bind(self.blocks, 'b', block)
+
+        inputs = []
+        for name, function in diagram.inputs.items():
+            if isinstance(function, InputSignal):
+                self.tabulated.append(name)
+                inputs.append(f'{signal(name)} = i{len(self.tabulated) - 1}[n]')
+            else:
+                inputs.append(f'{signal(name)} = {bind(self.functions, "f", function)}(t)')
+
+        # Scalar realisations get a local for each state, others one for the state vector
+        nstates = 0
+        for block in diagram.blocks:
+            if self._inline(block):
+                nx = block.realisation.A.shape[0] if self._scalar(block) else 1
+                self.states[block] = [f'x{nstates + j}' for j in range(nx)]
+                nstates += nx
+
+        sampled = bool(diagram.sampled)
+        body = []
+        for output, terms, block, i in diagram.program:
+            if block is None:
+                expression = ' '.join(f"{'+' if sign > 0 else '-'} s{j}" for j, sign in terms)
+                body.append(f's{output} = {expression.lstrip("+ ")}')
+                continue
+            u = f's{i}'
+            if isinstance(block, Zero):
+                line = f's{output} = 0'
+            elif block in self.states:
+                expression = self._output(block, u, constant)
+                if block.delay:
+                    expression = f'{block_name(block.delay)}.change_input(t, {expression})'
+                line = f's{output} = {expression}'
+            else:
+                line = f's{output} = {block_name(block)}.change_input(t, {u})'
+            if sampled and block.sample_time is not None:
+                line = f'if sample:\n    {line}'
+            body.append(line)
+        if sampled:
+            body.insert(0, 'sample = t >= next_event')
+            body.append('if sample:\n    next_event = schedule()')
+
+        # All the states are integrated once the signals are known
+        for block in diagram.blocks:
+            if block.sample_time is not None or isinstance(block, (Zero, AlgebraicEquation, Deadtime)):
+                continue
+            u = signal(block.inputname)
+            if block in self.states:
+                body.append(self._integrate(block, u, constant))
+            elif method == 'zoh' and isinstance(block, LTI):
+                body.append(f'{block_name(block)}.integrate({u}, dt)')
+            else:
+                body.append(f'{block_name(block)}.euler({u}, dt)')
+
+        locals_ = [f's{i}' for i in range(len(diagram.signal_names))]
+        states = [x for xs in self.states.values() for x in xs]
+        # The recorded values are collected in a list, which is much faster than writing them to data
+        if any(name in diagram.sizes for name in self.names):
+            record = f'append(hstack(({", ".join(signal(name) for name in self.names)},)))'
+        else:
+            record = f'append(({", ".join(signal(name) for name in self.names)},))'
+
+        lines = ['def make(dt, blocks, constants, functions, schedule, hstack):']
+        for items, prefix, argument in [(self.blocks, 'b', 'blocks'), (self.constants, 'c', 'constants'),
+                                        (self.functions, 'f', 'functions')]:
+            if items:
+                lines.append(f"    {', '.join(f'{prefix}{k}' for k in range(len(items)))}, = {argument}")
+        lines.append('')
+        lines.append('    def run(ts, columns, data, decimate, signals, states):')
+        if self.tabulated:
+            lines.append(f"        {', '.join(f'i{k}' for k in range(len(self.tabulated)))}, = columns")
+        lines.append(f"        {', '.join(locals_)}, = signals")
+        if states:
+            lines.append(f"        {', '.join(states)}, = states")
+        if sampled:
+            lines.append('        next_event = schedule()')
+        lines.append('        records = []')
+        lines.append('        append = records.append')
+        lines.append('        for n, t in enumerate(ts):')
+        for line in inputs + body + [f'if n % decimate == 0:\n    {record}']:
+            lines.extend('            ' + part for part in line.split('\n'))
+        lines.append('        if records:')
+        lines.append('            data[:, :len(records)] = numpy.array(records).T')
+        lines.append(f"        return [{', '.join(locals_)}], [{', '.join(states)}]")
+        lines.append('')
+        lines.append('    return run')
+        self.source = '\n'.join(lines) + '\n'
+
+        self.key = hashlib.sha256(self.source.encode()).hexdigest()
+        make = compile_generated(self.source, self.key)
+        self.run_function = make(dt, self.blocks, self.constants, self.functions, diagram.schedule, numpy.hstack)
+
+        self.signals = list(diagram.values)
+        self.x = []
+        for block in self.states:
+            if self._scalar(block):
+                self.x.extend(block.x.ravel().tolist())
+            else:
+                self.x.append(block.x)
+
+    @staticmethod
+    def _inline(block):
+        return isinstance(block, LTI) and not isinstance(block, MIMO) and CompiledDiagram._linear(block)
+
+    @staticmethod
+    def _scalar(block):
+        return isinstance(block.realisation, (FirstOrderStateSpace, SecondOrderStateSpace))
+
+    def _output(self, block, u, constant):
+        r = block.realisation
+        x = self.states[block]
+        if isinstance(r, FirstOrderStateSpace):
+            return f'{constant(r.c)}*{x[0]} + {constant(r.d)}*{u}'
+        if isinstance(r, SecondOrderStateSpace):
+            return f'{constant(r.c1)}*{x[0]} + {constant(r.c2)}*{x[1]} + {constant(r.d)}*{u}'
+        return f'({constant(r.C)}.dot({x[0]}) + {constant(r.D)}.dot({u}))[0, 0]'
+
+    def _integrate(self, block, u, constant):
+        r = block.realisation
+        x = self.states[block]
+        if self.method == 'zoh':
+            Ad, Bd = r.discretise(self.dt)
+            if isinstance(r, FirstOrderStateSpace):
+                return f'{x[0]} = {constant(float(Ad[0, 0]))}*{x[0]} + {constant(float(Bd[0, 0]))}*{u}'
+            if isinstance(r, SecondOrderStateSpace):
+                ((a11, a12), (a21, a22)), (b1, b2) = Ad.tolist(), Bd[:, 0].tolist()
+                return (f'{x[0]}, {x[1]} = '
+                        f'{constant(a11)}*{x[0]} + {constant(a12)}*{x[1]} + {constant(b1)}*{u}, '
+                        f'{constant(a21)}*{x[0]} + {constant(a22)}*{x[1]} + {constant(b2)}*{u}')
+            return f'{x[0]} = {constant(Ad)}.dot({x[0]}) + {constant(Bd)}.dot({u})'
+        if isinstance(r, FirstOrderStateSpace):
+            return f'{x[0]} += ({constant(r.a)}*{x[0]} + {constant(r.b)}*{u})*dt'
+        if isinstance(r, SecondOrderStateSpace):
+            return (f'{x[0]}, {x[1]} = '
+                    f'{x[0]} + ({constant(r.a11)}*{x[0]} + {constant(r.a12)}*{x[1]} + {constant(r.b1)}*{u})*dt, '
+                    f'{x[1]} + ({constant(r.a21)}*{x[0]} + {constant(r.a22)}*{x[1]} + {constant(r.b2)}*{u})*dt')
+        return f'{x[0]} = {x[0]} + ({constant(r.A)}.dot({x[0]}) + {constant(r.B)}.dot({u}))*dt'
+
+    def run(self, ts, data=None, decimate=1):
+        """Advance the diagram over the times ts, continuing from the last run
+
+        :param ts: times, which must be spaced by the timestep the function was generated for
+        :param data: array with a row for each recorded signal (or a block of rows for
+                     vector signals) and a column for each recorded time, like SimulationResult.data
+        :param decimate: only record every decimate'th timestep
+        :return: data
+        """
+        if data is None:
+            data = SimulationResult(self.names, ts[::decimate], sizes=self.diagram.sizes).data
+        table = self.diagram.tabulate(ts)
+        columns = [table[name].tolist() if table[name].ndim == 1 else table[name] for name in self.tabulated]
+        self.signals, self.x = self.run_function(numpy.asarray(ts, dtype=float).tolist(), columns, data,
+                                                 decimate, self.signals, self.x)
+        return data
+
+    def store(self):
+        """Copy the signals and the states and outputs of the inlined blocks back to the diagram"""
+        diagram = self.diagram
+        diagram.values = list(self.signals)
+        diagram.signals.update(zip(diagram.signal_names, self.signals))
+        x = iter(self.x)
+        for block, names in self.states.items():
+            if self._scalar(block):
+                block.change_state(numpy.array([[next(x)] for name in names]))
+            else:
+                block.change_state(next(x))
+            block.y = block.output = diagram.signals[block.outputname]
+
+
+class AdaptiveSolver:
+    """Continuous time simulation of a Diagram with an adaptive step ODE solver
+
+    The states of all the LTI blocks are integrated together by one of the
+    scipy.integrate.OdeSolver classes. Signals are calculated from the states
+    in causal order (see Diagram.evaluation_order), so unlike the fixed step
+    methods there is no lag of one timestep around loops.
+
+    The integration is restarted at the breakpoints of the input functions
+    (see step), at the sample times of DiscreteTF blocks and one delay after
+    each of these. The inputs of delayed blocks are stored as a cubic
+    polynomial for each accepted step, which is why the step size is limited
+    to the smallest delay. Output is interpolated onto the requested times.
+
+    Only LTI (including controllers), Zero, AlgebraicEquation, Deadtime and
+    DiscreteTF blocks are supported. The functions of AlgebraicEquation blocks
+    and the inputs may be called at any time, in any order.
+    """
+    # Interpolation nodes within a step for the history of delayed signals
+    nodes = numpy.linspace(0, 1, 4)
+    node_inverse = numpy.linalg.inv(numpy.vander(nodes))
+
+    def __init__(self, diagram, solver='RK45', rtol=1e-6, atol=1e-9, max_step=numpy.inf):
+        """:param diagram: Diagram to simulate
+           :param solver: name of a scipy.integrate.OdeSolver class like 'RK45', 'BDF' or 'LSODA'
+           :param rtol: relative tolerance
+           :param atol: absolute tolerance
+           :param max_step: largest allowed step size
+        """
+        supported = (LTI, Zero, AlgebraicEquation, Deadtime, DiscreteTF)
+        for block in diagram.blocks:
+            if isinstance(block, MIMO) or not isinstance(block, supported):
+                raise ValueError(f"The adaptive solver cannot simulate the block '{block.name}', only single "
+                                 f"input LTI, Zero, AlgebraicEquation, Deadtime and DiscreteTF blocks")
+
+        self.diagram = diagram
+        self.solver = getattr(scipy.integrate, solver)
+        self.rtol = rtol
+        self.atol = atol
+        self.order = diagram.evaluation_order(self.feedthrough)
+
+        self.states = {}
+        nx = 0
+        for block in diagram.blocks:
+            if isinstance(block, LTI):
+                self.states[block] = slice(nx, nx + block.realisation.A.shape[0])
+                nx += block.realisation.A.shape[0]
+        # OdeSolvers need at least one state
+        self.nx = max(nx, 1)
+
+        self.delays = {}
+        for block in diagram.blocks:
+            if isinstance(block, LTI) and block.delay:
+                self.delays[block] = block.delay.delay
+            elif isinstance(block, Deadtime) and block.delay > 0:
+                self.delays[block] = block.delay
+        self.max_step = min([max_step, *self.delays.values()])
+        self.discrete = [block for block in diagram.blocks if isinstance(block, DiscreteTF)]
+
+    @staticmethod
+    def feedthrough(block):
+        # Discrete blocks are sampled separately, so their output is held
+        return not isinstance(block, DiscreteTF) and block.feedthrough
+
+    def lookup(self, block, t):
+        """Value of the undelayed signal of a delayed block at time t"""
+        starts, pieces = self.history[block]
+        i = bisect.bisect_right(starts, t) - 1
+        if i < 0:
+            return numpy.interp(t, *self.past[block])
+        t0, h, coefficients = pieces[i]
+        return numpy.polyval(coefficients, (t - t0)/h)
+
+    def evaluate(self, t, X):
+        """Calculate all the signals at time t for states X"""
+        signals = dict(self.diagram.signals)
+        for signal, function in self.diagram.inputs.items():
+            signals[signal] = function(t)
+        for kind, item in self.order:
+            if kind == 'sum':
+                signals[item] = sum(int(s[0]+'1')*signals[s[1:]] for s in self.diagram.sums[item])
+                continue
+            block = item
+            u = signals[block.inputname]
+            if isinstance(block, LTI):
+                if not CompiledDiagram._linear(block):
+                    y = block.output
+                elif block.delay:
+                    y = self.lookup(block, t - block.delay.delay)
+                else:
+                    y = block.realisation.C.dot(X[self.states[block]])[0] + block.realisation.D[0, 0]*u
+            elif isinstance(block, Deadtime):
+                y = self.lookup(block, t - block.delay) if block in self.delays else u
+            elif isinstance(block, AlgebraicEquation):
+                y = block.f(t, u)
+            elif isinstance(block, DiscreteTF):
+                y = block.output
+            else:
+                y = 0
+            signals[block.outputname] = y
+        return signals
+
+    def undelayed(self, signals, X):
+        """Values of the signals entering the delays of delayed blocks"""
+        values = {}
+        for block in self.delays:
+            u = signals[block.inputname]
+            if isinstance(block, LTI):
+                values[block] = block.realisation.C.dot(X[self.states[block]])[0] + block.realisation.D[0, 0]*u
+            else:
+                values[block] = u
+        return values
+
+    def derivative(self, t, X):
+        signals = self.evaluate(t, X)
+        dX = numpy.zeros_like(X)
+        for block, x in self.states.items():
+            dX[x] = block.realisation.A.dot(X[x]) + block.realisation.B[:, 0]*signals[block.inputname]
+        return dX
+
+    def simulate(self, ts, result, pbar=None):
+        """Simulate the diagram, storing the signals at the times of result.t in result"""
+        t_start, t_end = ts[0], ts[-1]
+        self.history = {block: ([], []) for block in self.delays}
+        self.past = {block: (block.delay if isinstance(block, LTI) else block).history()
+                     for block in self.delays}
+
+        samples = {}
+        for block in self.discrete:
+            for t in numpy.arange(0, t_end + block.dt/2, block.dt):
+                if t >= t_start:
+                    samples.setdefault(t, []).append(block)
+        breakpoints = set(samples)
+        for function in self.diagram.inputs.values():
+            if isinstance(function, InputSignal):
+                breakpoints.update(function.breakpoints_between(t_start, t_end))
+            else:
+                breakpoints.update(getattr(function, 'breakpoints', ()))
+        breakpoints.update([b + delay for b in list(breakpoints) for delay in self.delays.values()])
+        events = sorted(b for b in breakpoints if t_start < b < t_end) + [t_end]
+
+        X = numpy.zeros(self.nx)
+        for block, x in self.states.items():
+            X[x] = block.x.ravel()
+
+        times = result.t
+        k = 0
+
+        def record(t, X):
+            nonlocal k
+            signals = self.evaluate(t, X)
+            result.data[:, k] = [signals[name] for name in result.names]
+            k += 1
+            if pbar:
+                pbar.update()
+
+        def sample(t, X):
+            signals = self.evaluate(t, X)
+            for block in samples.get(t, []):
+                block.change_input(t, signals[block.inputname])
+
+        t = t_start
+        for t_next in events:
+            sample(t, X)
+            solver = self.solver(self.derivative, t, X, t_next,
+                                 rtol=self.rtol, atol=self.atol, max_step=self.max_step)
+            while solver.status == 'running':
+                solver.step()
+                if solver.status == 'failed':
+                    raise RuntimeError(f"Adaptive solver failed at t={solver.t}: {solver.message}")
+                interpolant = solver.dense_output()
+                t0, t1 = solver.t_old, solver.t
+                if self.delays:
+                    h = t1 - t0
+                    values = []
+                    for node in t0 + h*self.nodes:
+                        Xnode = interpolant(node)
+                        values.append(self.undelayed(self.evaluate(node, Xnode), Xnode))
+                    for block, (starts, pieces) in self.history.items():
+                        starts.append(t0)
+                        pieces.append((t0, h, self.node_inverse.dot([v[block] for v in values])))
+                while k < len(times) and times[k] < t1:
+                    record(times[k], interpolant(times[k]))
+            X = solver.y
+            t = t_next
+        sample(t, X)
+        while k < len(times):
+            record(times[k], X)
+
+        for block, x in self.states.items():
+            block.change_state(X[x].reshape(-1, 1))
+        return result
+
+
+class Ensemble:
+    """Many variants of the same diagram simulated in lockstep
+
+    Each variant is compiled separately (see CompiledDiagram) and the
+    resulting matrices are stacked so that all the variants are advanced
+    together with batched matrix products. The variants must have the same
+    structure, only the parameters of the blocks may differ.
+
+    Example
+
+    >>> def factory(Kc, tau_i):
+    ...     return simple_control_diagram(PI('Gc', 'e', 'u', Kc, tau_i),
+    ...                                   LTI('G', 'u', 'yu', 1, [10, 1]))
+    >>> ensemble = Ensemble(factory, {'Kc': [1, 2, 3], 'tau_i': [10, 10, 5]})
+    >>> results = ensemble.simulate(ts)
+    >>> results['y'].shape == (3, len(ts))
+    True
+    """
+    def __init__(self, factory, parameters):
+        """:param factory: function accepting the parameters as keyword arguments and returning a Diagram
+           :param parameters: dictionary with keys equal to parameter names and values arrays of parameter values, one per variant
+        """
+        lengths = {len(values) for values in parameters.values()}
+        if len(lengths) != 1:
+            raise ValueError("All the parameter arrays must have the same length")
+        self.N = lengths.pop()
+        self.parameters = parameters
+        self.diagrams = [factory(**{name: values[i] for name, values in parameters.items()})
+                         for i in range(self.N)]
+
+    def simulate(self, ts, progress=False, method='euler'):
+        """Simulate all the variants
+
+        :param ts: iterable, timesteps to simulate. Note this should be equally spaced
+        :param progress: display progress bar
+        :param method: integration method, 'euler' or 'zoh' (see Diagram.step)
+
+        Returns dictionary with keys for each signal in the diagram and values arrays of shape (N, len(ts)),
+        or (N, size, len(ts)) for vector signals
+        """
+        if progress:
+            from tqdm.auto import tqdm as tqdm
+            pbar = tqdm(total=len(ts))
+        dt = ts[1] - ts[0]
+        engines = []
+        for diagram in self.diagrams:
+            diagram.reset()
+            engines.append(CompiledDiagram(diagram, dt, method))
+
+        def structure(engine):
+            return (engine.signal_names, engine.z.shape,
+                    [[(Phi is None, [(i, o) for _, i, o in callouts]) for Phi, callouts in segments]
+                     for segments in (engine.segments, engine.between)])
+
+        first = engines[0]
+        if any(structure(engine) != structure(first) for engine in engines[1:]):
+            raise ValueError("All the variants must have the same structure")
+
+        def stack(attribute):
+            stacked = []
+            for j, (Phi, callouts) in enumerate(getattr(first, attribute)):
+                variants = [getattr(engine, attribute)[j] for engine in engines]
+                if Phi is not None:
+                    Phi = numpy.stack([_dense(variant[0]) for variant in variants])
+                callouts = [([variant[1][k][0] for variant in variants], i, o)
+                            for k, (_, i, o) in enumerate(callouts)]
+                stacked.append((Phi, callouts))
+            return stacked
+
+        segments = stack('segments')
+        between = stack('between')
+        diagrams = [engine.diagram for engine in engines]
+        next_event = min(diagram.schedule() for diagram in diagrams)
+
+        # Inputs shared by all the variants are evaluated once, for all the times if possible
+        input_functions = []
+        for k, (i, function) in enumerate(first.input_functions):
+            functions = [engine.input_functions[k][1] for engine in engines]
+            if all(f is function for f in functions):
+                functions = function
+                if isinstance(function, InputSignal):
+                    functions = numpy.asarray(function(numpy.asarray(ts, dtype=float)), dtype=float)
+            input_functions.append((i, functions))
+
+        nsignals = first.nsignals
+        outputs = numpy.empty((nsignals, self.N, len(ts)))
+        z = numpy.stack([engine.z for engine in engines])
+        for n, t in enumerate(ts):
+            for i, functions in input_functions:
+                if isinstance(functions, numpy.ndarray):
+                    z[:, i] = functions[n]
+                elif callable(functions):
+                    z[:, i] = functions(t)
+                else:
+                    z[:, i] = [function(t) for function in functions]
+            sample = t >= next_event
+            for Phi, callouts in segments if sample else between:
+                if Phi is not None:
+                    z = numpy.matmul(Phi, z[:, :, numpy.newaxis])[:, :, 0]
+                for blocks, i, o in callouts:
+                    for variant, block in enumerate(blocks):
+                        u = z[variant, i]
+                        if o is not None:
+                            z[variant, o] = block.change_input(t, u)
+                        elif method == 'zoh' and isinstance(block, LTI):
+                            block.integrate(u, dt)
+                        else:
+                            block.euler(u, dt)
+            if sample:
+                next_event = min(diagram.schedule() for diagram in diagrams)
+            outputs[:, :, n] = z[:, :nsignals].T
+            if progress:
+                pbar.update()
 
-def zero(t):
-    """This function returns zero for all time"""
-    return 0
+        for engine, zn in zip(engines, z):
+            engine.z = zn
+            engine.store()
+        return {name: outputs[i] if isinstance(i, int) else outputs[i].transpose(1, 0, 2)
+                for i, name in first.outputs}
 
 
 def simple_control_diagram(Gc, G, Gd=None, Gm=None, ysp=step(), d=zero):
@@ -0,0 +1,291 @@
+import numpy
+import scipy.integrate
+
+
+class Metric:
+    """Scalar measure of the performance of a simulation, like the IAE of the error
+
+    A metric is called with a SimulationResult containing the signals listed
+    in its signals attribute. It can also be accumulated while the diagram is
+    simulated (see Diagram.simulate), so the signals need not be recorded:
+    start() returns a new accumulator state, update(state, t, *values) adds
+    the values of the signals at time t to it, extend(state, ts, *values) adds
+    arrays of values for blocks of times and finish(state) returns the value
+    of the metric as a float. Metrics do not keep any state themselves, so one
+    metric can be used for many simulations at the same time.
+
+    Metrics which are differentiable also implement gradient, which is used
+    for tuning with Diagram.simulate_sensitivity.
+    """
+    signals = []
+
+    def __call__(self, result):
+        return self.accumulate(result)
+
+    def accumulate(self, result):
+        """Value of the metric accumulated over a recorded result, as during a simulation"""
+        state = self.start()
+        self.extend(state, result.t, *[result[signal] for signal in self.signals])
+        return self.finish(state)
+
+    def extend(self, state, ts, *values):
+        """Add arrays of the values of the signals at the times ts to the accumulator state
+
+        By default this calls update for every time, subclasses override it with array operations.
+        """
+        for t, *row in zip(numpy.asarray(ts).tolist(), *[numpy.asarray(v).tolist() for v in values]):
+            self.update(state, t, *row)
+
+    def start(self):
+        raise NotImplementedError
+
+    def update(self, state, t, *values):
+        raise NotImplementedError
+
+    def finish(self, state):
+        raise NotImplementedError
+
+    def gradient(self, result, sensitivities):
+        """Derivatives of the metric with respect to parameters
+
+        :param result: SimulationResult with the signals of the metric
+        :param sensitivities: list of SimulationResults with the derivatives of those
+                              signals with respect to each parameter
+        :return: array with the derivative with respect to each parameter
+        """
+        raise NotImplementedError(f"{type(self).__name__} has no gradient")
+
+
+class IAE(Metric):
+    """Integral of the absolute value of a signal, normally the error"""
+    def __init__(self, signal='e'):
+        self.signal = signal
+        self.signals = [signal]
+
+    def integrand(self, t, e):
+        return abs(e)
+
+    def integrand_derivative(self, t, e):
+        """Derivative of the integrand with respect to e"""
+        return numpy.sign(e)
+
+    def __call__(self, result):
+        return float(scipy.integrate.trapezoid(self.integrand(result.t, result[self.signal]), result.t))
+
+    def gradient(self, result, sensitivities):
+        weights = self.integrand_derivative(result.t, result[self.signal])
+        return numpy.array([scipy.integrate.trapezoid(weights*sensitivity[self.signal], result.t)
+                            for sensitivity in sensitivities])
+
+    # The state is [previous t, previous integrand, integral] for the trapezoidal rule
+    def start(self):
+        return [None, 0.0, 0.0]
+
+    def update(self, state, t, e):
+        f = self.integrand(t, e)
+        if state[0] is not None:
+            state[2] += 0.5*(f + state[1])*(t - state[0])
+        state[0] = t
+        state[1] = f
+
+    def extend(self, state, ts, e):
+        if len(ts) == 0:
+            return
+        ts = numpy.asarray(ts, dtype=float)
+        f = self.integrand(ts, numpy.asarray(e, dtype=float))
+        # The last point of the previous block starts the first interval
+        if state[0] is not None:
+            ts = numpy.concatenate(([state[0]], ts))
+            f = numpy.concatenate(([state[1]], f))
+        state[2] += scipy.integrate.trapezoid(f, ts)
+        state[0] = ts[-1]
+        state[1] = f[-1]
+
+    def finish(self, state):
+        return float(state[2])
+
+
+class ITAE(IAE):
+    """Integral of time times the absolute value of a signal, normally the error"""
+    def integrand(self, t, e):
+        return t*abs(e)
+
+    def integrand_derivative(self, t, e):
+        return t*numpy.sign(e)
+
+
+class ISE(IAE):
+    """Integral of the square of a signal, normally the error"""
+    def integrand(self, t, e):
+        return e*e
+
+    def integrand_derivative(self, t, e):
+        return 2*e
+
+
+class MaxDeviation(Metric):
+    """Largest absolute value of a signal, normally the error after a disturbance"""
+    def __init__(self, signal='e'):
+        self.signal = signal
+        self.signals = [signal]
+
+    def __call__(self, result):
+        return float(numpy.max(numpy.abs(result[self.signal])))
+
+    def gradient(self, result, sensitivities):
+        e = result[self.signal]
+        i = numpy.argmax(numpy.abs(e))
+        return numpy.array([numpy.sign(e[i])*sensitivity[self.signal][i] for sensitivity in sensitivities])
+
+    def start(self):
+        return [0.0]
+
+    def update(self, state, t, e):
+        state[0] = max(state[0], abs(e))
+
+    def extend(self, state, ts, e):
+        if len(ts):
+            state[0] = max(state[0], numpy.max(numpy.abs(e)))
+
+    def finish(self, state):
+        return float(state[0])
+
+
+class Overshoot(Metric):
+    """Largest excursion of a signal past the final setpoint as a fraction of the setpoint change
+
+    This is 0 if the final setpoint equals the initial value of the signal,
+    like in a run with only disturbances.
+    """
+    def __init__(self, signal='y', setpoint='ysp'):
+        self.signal = signal
+        self.setpoint = setpoint
+        self.signals = [signal, setpoint]
+
+    def __call__(self, result):
+        y = result[self.signal]
+        r = result[self.setpoint][-1]
+        change = r - y[0]
+        if change == 0:
+            return 0.0
+        return float(max(0, numpy.max((y - r)*numpy.sign(change))/abs(change)))
+
+    def gradient(self, result, sensitivities):
+        # The setpoint is an input, so only y depends on the parameters
+        y = result[self.signal]
+        r = result[self.setpoint][-1]
+        change = r - y[0]
+        if change == 0:
+            return numpy.zeros(len(sensitivities))
+        excess = (y - r)*numpy.sign(change)
+        i = numpy.argmax(excess)
+        if excess[i] <= 0:
+            return numpy.zeros(len(sensitivities))
+        return numpy.array([numpy.sign(change)*s[self.signal][i]/abs(change)
+                            + excess[i]*numpy.sign(change)*s[self.signal][0]/change**2
+                            for s in sensitivities])
+
+    # The state is [initial y, largest y, smallest y, last setpoint]
+    def start(self):
+        return [None, -numpy.inf, numpy.inf, None]
+
+    def update(self, state, t, y, r):
+        if state[0] is None:
+            state[0] = y
+        state[1] = max(state[1], y)
+        state[2] = min(state[2], y)
+        state[3] = r
+
+    def extend(self, state, ts, y, r):
+        if len(ts) == 0:
+            return
+        if state[0] is None:
+            state[0] = y[0]
+        state[1] = max(state[1], numpy.max(y))
+        state[2] = min(state[2], numpy.min(y))
+        state[3] = r[-1]
+
+    def finish(self, state):
+        y0, largest, smallest, r = state
+        change = r - y0
+        if change == 0:
+            return 0.0
+        return float(max(0, (largest - r if change > 0 else r - smallest)/abs(change)))
+
+
+class SettlingTime(Overshoot):
+    """Time after which a signal stays within a band around the final setpoint
+
+    The band is a fraction of the setpoint change. Returns inf if the signal
+    has not settled at the end of the simulation. When accumulated, the signal
+    counts as outside the band until the last change of the setpoint. If the
+    final setpoint equals the initial value of the signal the band has no
+    width, so like Overshoot this returns the start time instead.
+    """
+    def __init__(self, signal='y', setpoint='ysp', tolerance=0.02):
+        super().__init__(signal, setpoint)
+        self.tolerance = tolerance
+
+    # The settling time jumps between timesteps as the parameters change, so it has no useful gradient
+    gradient = Metric.gradient
+
+    def __call__(self, result):
+        y = result[self.signal]
+        r = result[self.setpoint][-1]
+        if r == y[0]:
+            return float(result.t[0])
+        outside = numpy.flatnonzero(numpy.abs(y - r) > self.tolerance*abs(r - y[0]))
+        if len(outside) == 0:
+            return float(result.t[0])
+        if outside[-1] == len(y) - 1:
+            return numpy.inf
+        return float(result.t[outside[-1] + 1])
+
+    # The state is [initial y, setpoint, time since which y has been in the band or None, start time]
+    def start(self):
+        return [None, None, None, None]
+
+    def update(self, state, t, y, r):
+        if state[0] is None:
+            state[0] = y
+            state[3] = t
+        if r != state[1]:
+            state[1] = r
+            state[2] = None
+        if abs(y - r) > self.tolerance*abs(r - state[0]):
+            state[2] = None
+        elif state[2] is None:
+            state[2] = t
+
+    def extend(self, state, ts, y, r):
+        if len(ts) == 0:
+            return
+        y = numpy.asarray(y, dtype=float)
+        r = numpy.asarray(r, dtype=float)
+        if state[0] is None:
+            state[0] = y[0]
+            state[3] = ts[0]
+        outside = numpy.abs(y - r) > self.tolerance*numpy.abs(r - state[0])
+        # Like update, the band is left at every point outside it and every setpoint change
+        previous = numpy.concatenate(([numpy.nan if state[1] is None else state[1]], r[:-1]))
+        left = numpy.flatnonzero(outside | (r != previous))
+        if len(left):
+            k = left[-1]
+            if not outside[k]:
+                state[2] = ts[k]
+            else:
+                state[2] = ts[k + 1] if k + 1 < len(ts) else None
+        elif state[2] is None:
+            state[2] = ts[0]
+        state[1] = r[-1]
+
+    def finish(self, state):
+        if state[1] == state[0]:
+            return float(state[3])
+        return numpy.inf if state[2] is None else float(state[2])
+
+
+DEFAULT_METRICS = {'IAE': IAE(),
+                   'ITAE': ITAE(),
+                   'overshoot': Overshoot(),
+                   'settling_time': SettlingTime()}
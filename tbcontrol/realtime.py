@@ -0,0 +1,144 @@
+import asyncio
+import inspect
+import time
+import numpy
+
+from .blocksim import SimulationResult
+
+
+class RealTimeRunner:
+    """Run a Diagram against the wall clock, exchanging signals with external devices
+
+    Source signals are read from devices at the start of every step and
+    replace the inputs of the diagram with the same names, and sink signals are written to devices at the end
+    of the step. The read and write functions may be coroutine functions, which
+    are awaited. Other functions, like the blocking serial I/O of the TCLab,
+    are run in a separate thread (see asyncio.to_thread), so they do not stall
+    other tasks in the event loop. Steps are scheduled at absolute times start + n*dt, so timing
+    errors do not accumulate. A step which starts late runs immediately and
+    the diagram always advances by dt, so the simulation stays deterministic.
+
+    After a run, latency (time from the scheduled start of a step to the end of
+    its writes), jitter (time from the scheduled start to the actual start) and
+    the number of deadline misses (steps finishing after the next step was due)
+    are available in the latency, jitter and deadline_misses attributes and
+    summarised by timing().
+
+    Example with the TCLab (or TCLabModel as a stand-in)
+
+    >>> from tbcontrol import blocksim
+    >>> lab = tclab.TCLab()
+    >>> Gc = blocksim.PI('Gc', 'e', 'Q1', Kc=5, tau_i=100)
+    >>> diagram = blocksim.Diagram([Gc], {'e': ('+T1sp', '-T1')}, {'T1sp': blocksim.step(30), 'T1': blocksim.zero})
+    >>> runner = RealTimeRunner(diagram, 1, sources={'T1': lambda: lab.T1}, sinks={'Q1': lab.Q1})
+    >>> result = asyncio.run(runner.run(600))
+    """
+    def __init__(self, diagram, dt, sources=None, sinks=None, record=None, method='euler',
+                 clock=time.monotonic, sleep=asyncio.sleep):
+        """:param diagram: Diagram to run
+           :param dt: timestep in seconds
+           :param sources: dictionary with keys equal to input signal names and values functions
+                           (or coroutine functions) without arguments reading the signal
+           :param sinks: dictionary with keys equal to signal names and values functions
+                         (or coroutine functions) accepting the signal value
+           :param record: iterable of signal names to record. All signals are recorded if None
+           :param method: integration method, 'euler' or 'zoh' (see Diagram.step)
+           :param clock: function returning the time in seconds
+           :param sleep: coroutine function sleeping for a number of seconds
+        """
+        self.diagram = diagram
+        self.dt = dt
+        self.sources = sources or {}
+        for name in self.sources:
+            if name not in diagram.inputs:
+                raise ValueError(f"The source signal '{name}' is not an input of the diagram")
+        self.sinks = sinks or {}
+        for name in self.sinks:
+            if name not in diagram.signals:
+                raise ValueError(f"The sink signal '{name}' is not a signal of the diagram")
+        self.record = record
+        self.method = method
+        self.clock = clock
+        self.sleep = sleep
+        self.running = False
+        self.latency = numpy.zeros(0)
+        self.jitter = numpy.zeros(0)
+        self.deadline_misses = 0
+
+    @staticmethod
+    async def call(function, *args):
+        """Await a coroutine function, or run another function in a separate thread"""
+        if inspect.iscoroutinefunction(function):
+            return await function(*args)
+        return await asyncio.to_thread(function, *args)
+
+    def stop(self):
+        """Stop the run after the current step"""
+        self.running = False
+
+    async def run(self, t_end):
+        """Run the diagram in real time until t_end seconds have passed or stop is called
+
+        Returns a SimulationResult with the recorded signals
+        """
+        diagram = self.diagram
+        dt = self.dt
+        measured = {}
+        original_inputs = diagram.inputs
+        diagram.inputs = dict(original_inputs)
+        for name in self.sources:
+            diagram.inputs[name] = lambda t, name=name: measured[name]
+
+        try:
+            diagram.reset()
+            names = diagram.record_names(self.record)
+            advance, select, finish = diagram.stepper(dt, names, method=self.method)
+            sink_rows = [diagram.signal_names.index(name) for name in self.sinks]
+            nsteps = int(round(t_end/dt)) + 1
+            result = SimulationResult(names, numpy.arange(nsteps)*dt, sizes=diagram.sizes)
+            self.latency = numpy.zeros(nsteps)
+            self.jitter = numpy.zeros(nsteps)
+            self.deadline_misses = 0
+            self.running = True
+
+            start = self.clock()
+            n = 0
+            while n < nsteps and self.running:
+                deadline = start + n*dt
+                remaining = deadline - self.clock()
+                if remaining > 0:
+                    await self.sleep(remaining)
+                self.jitter[n] = self.clock() - deadline
+
+                for name, read in self.sources.items():
+                    measured[name] = await self.call(read)
+                values = advance(n*dt)
+                for (name, write), i in zip(self.sinks.items(), sink_rows):
+                    await self.call(write, values[i])
+                result.data[:, n] = select(values)
+
+                finished = self.clock()
+                self.latency[n] = finished - deadline
+                if finished > deadline + dt:
+                    self.deadline_misses += 1
+                n += 1
+            finish()
+        finally:
+            diagram.inputs = original_inputs
+            self.running = False
+
+        self.latency = self.latency[:n]
+        self.jitter = self.jitter[:n]
+        return SimulationResult(names, result.t[:n], result.data[:, :n], diagram.sizes)
+
+    def timing(self):
+        """Summary of the timing of the last run as a dictionary, with nan times before the first run"""
+        def summary(function, values):
+            return float(function(values)) if len(values) else numpy.nan
+
+        return {'steps': len(self.latency),
+                'mean_latency': summary(numpy.mean, self.latency),
+                'max_latency': summary(numpy.max, self.latency),
+                'mean_jitter': summary(numpy.mean, self.jitter),
+                'max_jitter': summary(numpy.max, self.jitter),
+                'deadline_misses': self.deadline_misses}
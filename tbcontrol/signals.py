@@ -0,0 +1,196 @@
+import numpy
+
+# Fraction of the sample time by which a timestep may fall short of a sample
+# instant and still take the sample, so rounding in the times does not move
+# samples to the next timestep.
+SAMPLE_TOLERANCE = 1e-6
+
+
+class InputSignal:
+    """Input function of time which can also be evaluated for an array of times
+
+    Any function of t can be used as an input of a Diagram, but these are
+    evaluated for all the times of a simulation at once before it starts
+    (see Diagram.tabulate), instead of once per timestep. They do not keep
+    any state, so the same signal can be used in many diagrams and runs.
+
+    Subclasses implement values(t) for an array t. Calling the signal with a
+    scalar time returns a scalar and with an array returns an array.
+
+    :attribute breakpoints: times at which the signal or its slope jumps
+    """
+    breakpoints = ()
+
+    def __call__(self, t):
+        if numpy.ndim(t):
+            return self.values(numpy.asarray(t, dtype=float))
+        return self.value(t)
+
+    def value(self, t):
+        """Value at the scalar time t"""
+        return self.values(numpy.array([t], dtype=float))[0]
+
+    def values(self, t):
+        """Values at the times in the array t"""
+        raise NotImplementedError
+
+    def breakpoints_between(self, t_start, t_end):
+        """Breakpoints in the interval [t_start, t_end], used by the adaptive solver"""
+        return [b for b in self.breakpoints if t_start <= b <= t_end]
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({', '.join(f'{k}={v!r}' for k, v in vars(self).items())})"
+
+
+class Constant(InputSignal):
+    """Constant value, which may be an array for vector signals"""
+    def __init__(self, value):
+        self.constant = value
+
+    def value(self, t):
+        return self.constant
+
+    def values(self, t):
+        return numpy.broadcast_to(self.constant, t.shape + numpy.shape(self.constant))
+
+
+class Step(InputSignal):
+    """Step from initial to initial + size at starttime"""
+    def __init__(self, initial=0, starttime=0, size=1):
+        self.initial = initial
+        self.starttime = starttime
+        self.size = size
+
+    @property
+    def breakpoints(self):
+        return [self.starttime]
+
+    def value(self, t):
+        if t < self.starttime:
+            return self.initial
+        else:
+            return self.initial + self.size
+
+    def values(self, t):
+        return numpy.where(t < self.starttime, self.initial, self.initial + self.size)
+
+
+class Ramp(InputSignal):
+    """Ramp with the given slope starting from initial at starttime"""
+    def __init__(self, slope=1, starttime=0, initial=0):
+        self.slope = slope
+        self.starttime = starttime
+        self.initial = initial
+
+    @property
+    def breakpoints(self):
+        return [self.starttime]
+
+    def value(self, t):
+        return self.initial + self.slope*max(t - self.starttime, 0)
+
+    def values(self, t):
+        return self.initial + self.slope*numpy.maximum(t - self.starttime, 0)
+
+
+class PulseTrain(InputSignal):
+    """Pulses of height size and duration width every period, starting at starttime"""
+    def __init__(self, period, width, size=1, starttime=0, initial=0):
+        if not 0 < width <= period:
+            raise ValueError("The pulse width must be positive and at most the period")
+        self.period = period
+        self.width = width
+        self.size = size
+        self.starttime = starttime
+        self.initial = initial
+
+    def values(self, t):
+        # Times are rounded like sample instants, so pulses start on the timestep at their start
+        cycles = (t - self.starttime)/self.period + SAMPLE_TOLERANCE
+        on = (cycles >= 0) & ((cycles - numpy.floor(cycles))*self.period < self.width)
+        return numpy.where(on, self.initial + self.size, self.initial)
+
+    def breakpoints_between(self, t_start, t_end):
+        first = max(numpy.floor((t_start - self.starttime)/self.period), 0)
+        starts = self.starttime + self.period*numpy.arange(first, max(first, (t_end - self.starttime)/self.period) + 1)
+        return [b for b in numpy.concatenate([starts, starts + self.width]).tolist() if t_start <= b <= t_end]
+
+
+class PRBS(InputSignal):
+    """Pseudo random binary sequence switching between initial ± amplitude
+
+    The sequence is the maximum length sequence of a linear feedback shift
+    register of the given order, which repeats after 2**order - 1 periods.
+    Its value is initial before starttime and can only change every period.
+    """
+    # Feedback taps of maximum length shift registers
+    taps = {2: (2, 1), 3: (3, 2), 4: (4, 3), 5: (5, 3), 6: (6, 5), 7: (7, 6),
+            8: (8, 6, 5, 4), 9: (9, 5), 10: (10, 7), 11: (11, 9)}
+
+    def __init__(self, period, amplitude=1, order=7, starttime=0, initial=0):
+        if order not in self.taps:
+            raise ValueError(f"The order must be one of {sorted(self.taps)}")
+        self.period = period
+        self.amplitude = amplitude
+        self.order = order
+        self.starttime = starttime
+        self.initial = initial
+        register = [1]*order
+        bits = []
+        for _ in range(2**order - 1):
+            bits.append(register[-1])
+            feedback = 0
+            for tap in self.taps[order]:
+                feedback ^= register[tap - 1]
+            register = [feedback] + register[:-1]
+        self.sequence = numpy.array(bits)
+
+    def values(self, t):
+        k = numpy.floor((t - self.starttime)/self.period + SAMPLE_TOLERANCE).astype(int)
+        levels = self.initial + self.amplitude*(2*self.sequence - 1)
+        return numpy.where(k >= 0, levels[k % len(self.sequence)], self.initial)
+
+    def breakpoints_between(self, t_start, t_end):
+        first = max(numpy.ceil((t_start - self.starttime)/self.period), 0)
+        last = numpy.floor((t_end - self.starttime)/self.period)
+        k = numpy.arange(first, last + 1).astype(int)
+        return (self.starttime + self.period*k).tolist()
+
+    def __repr__(self):
+        return (f"{self.__class__.__name__}(period={self.period!r}, amplitude={self.amplitude!r}, "
+                f"order={self.order!r}, starttime={self.starttime!r}, initial={self.initial!r})")
+
+
+class PiecewiseLinear(InputSignal):
+    """Linear interpolation between the points (times, values), constant outside them"""
+    def __init__(self, times, values):
+        self.times = numpy.asarray(times, dtype=float)
+        self.points = numpy.asarray(values, dtype=float)
+        if self.times.shape != self.points.shape or numpy.any(numpy.diff(self.times) < 0):
+            raise ValueError("times must be increasing and have the same length as values")
+
+    @property
+    def breakpoints(self):
+        return self.times.tolist()
+
+    def value(self, t):
+        return float(numpy.interp(t, self.times, self.points))
+
+    def values(self, t):
+        return numpy.interp(t, self.times, self.points)
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.times.tolist()!r}, {self.points.tolist()!r})"
+
+
+def step(initial=0, starttime=0, size=1):
+    """Return a Step, which can be used to simulate a step
+
+    The start time is available as the breakpoints attribute of the function,
+    which is used by the adaptive solver to restart integration there.
+    """
+    return Step(initial, starttime, size)
+
+
+# This input signal returns zero for all time
+zero = Constant(0)
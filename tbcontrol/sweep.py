@@ -0,0 +1,129 @@
+from collections.abc import Mapping
+import concurrent.futures
+import itertools
+import json
+import os
+
+from .metrics import Metric, DEFAULT_METRICS
+
+
+_sweep_setup = None
+
+
+def _sweep_initialise(*setup):
+    global _sweep_setup
+    _sweep_setup = setup
+
+
+def _sweep_chunk(tasks):
+    diagram_factory, ts, metrics, simulate_options, store = _sweep_setup
+    # Metrics are accumulated during the simulations if possible, so nothing needs to be recorded
+    accumulated = all(isinstance(metric, Metric) for metric in metrics.values())
+    if store is not None:
+        record = None
+    elif accumulated:
+        record = []
+    else:
+        record = sorted({signal for metric in metrics.values() for signal in metric.signals})
+    results = []
+    for index, parameters in tasks:
+        options = dict(simulate_options)
+        if store is not None:
+            options['store'] = os.path.join(store, str(index))
+        if accumulated:
+            options['metrics'] = metrics
+        result = diagram_factory(**parameters).simulate(ts, record=record, **options)
+        values = result.metrics if accumulated else {name: metric(result) for name, metric in metrics.items()}
+        results.append((index, {name: float(value) for name, value in values.items()}))
+    return results
+
+
+def sweep(diagram_factory, param_grid, ts, metrics=None, workers=None, chunksize=None, resume=None,
+          store=None, progress=False, **simulate_options):
+    """Simulate a diagram for many parameter values in a pool of processes
+
+    Each simulation is reduced to scalar metrics in the worker, so only small
+    results are sent back. With the default start method on some platforms the
+    factory and metrics must be picklable, so use module level functions.
+
+    :param diagram_factory: function accepting the parameters as keyword arguments and returning a Diagram
+    :param param_grid: dictionary with keys equal to parameter names and values lists of values,
+                       which is expanded to all combinations, or an iterable of parameter dictionaries
+    :param ts: timesteps to simulate
+    :param metrics: dictionary with keys equal to metric names and values Metrics, or
+                    functions of a SimulationResult with a signals attribute listing the
+                    signals they use. Metrics are accumulated during the simulations, so
+                    no signals are recorded unless some of them are functions.
+                    Defaults to DEFAULT_METRICS
+    :param workers: number of processes, defaults to the number of CPUs. With 1 the
+                    simulations are run in this process
+    :param chunksize: number of simulations sent to a worker at a time
+    :param resume: filename. Finished results are appended to this file as JSON lines
+                   and points with the same parameters as one already in the file are
+                   not simulated again
+    :param store: directory to keep all the signals of every simulation in. The result of
+                  point i is stored in the subdirectory str(i) (see SimulationResult.open)
+    :param progress: display progress bar
+    :param simulate_options: extra keyword arguments for Diagram.simulate
+
+    Returns a list of dictionaries containing the parameters and metrics of each point in order
+    """
+    if isinstance(param_grid, Mapping):
+        points = [dict(zip(param_grid, values)) for values in itertools.product(*param_grid.values())]
+    else:
+        points = list(param_grid)
+    if metrics is None:
+        metrics = DEFAULT_METRICS
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    # Finished points are matched by their parameters, so a file from another grid is never mixed in
+    def key(parameters):
+        return json.dumps(parameters, sort_keys=True, default=float)
+
+    keys = [key(point) for point in points]
+    done = {}
+    if resume is not None and os.path.exists(resume):
+        with open(resume) as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    done[key(entry['parameters'])] = entry['metrics']
+
+    todo = [i for i in range(len(points)) if keys[i] not in done]
+    if chunksize is None:
+        chunksize = max(1, -(-len(todo)//(4*workers)))
+    tasks = [[(i, points[i]) for i in todo[start:start + chunksize]]
+             for start in range(0, len(todo), chunksize)]
+
+    if progress:
+        from tqdm.auto import tqdm as tqdm
+        pbar = tqdm(total=len(todo))
+    setup = (diagram_factory, ts, metrics, simulate_options, store)
+    output = open(resume, 'a') if resume is not None else None
+    try:
+        if workers == 1:
+            _sweep_initialise(*setup)
+            chunks = map(_sweep_chunk, tasks)
+            executor = None
+        else:
+            executor = concurrent.futures.ProcessPoolExecutor(workers, initializer=_sweep_initialise,
+                                                              initargs=setup)
+            chunks = executor.map(_sweep_chunk, tasks)
+        for chunk in chunks:
+            for index, values in chunk:
+                done[keys[index]] = values
+                if output:
+                    output.write(json.dumps({'index': index, 'parameters': points[index],
+                                             'metrics': values}, default=float) + '\n')
+            if output:
+                output.flush()
+            if progress:
+                pbar.update(len(chunk))
+    finally:
+        if output:
+            output.close()
+        if executor:
+            executor.shutdown(cancel_futures=True)
+
+    return [{**points[i], **done[keys[i]]} for i in range(len(points))]
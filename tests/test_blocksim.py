@@ -0,0 +1,684 @@
+from tbcontrol import blocksim, realtime
+import asyncio
+import numpy
+import pytest
+import scipy.sparse
+
+
+def delayed_loop():
+    G = blocksim.LTI('G', 'ulimited', 'yu', 2, [10, 1], 2)
+    Gc = blocksim.PI('Gc', 'e', 'u', 0.5, 10)
+    limiter = blocksim.AlgebraicEquation('Limiter', 'u', 'ulimited',
+                                         lambda t, u: min(max(u, -1), 1))
+    Gd = blocksim.LTI('Gd', 'd', 'yd', 1, [5, 1])
+    return blocksim.Diagram([G, Gc, limiter, Gd],
+                            sums={'e': ('+ysp', '-y'), 'y': ('+yu', '+yd')},
+                            inputs={'ysp': blocksim.step(), 'd': blocksim.step(starttime=20)})
+
+
+class Gain(blocksim.Block):
+    """Custom block which the solvers do not know about"""
+    def reset(self):
+        self.state = 0
+
+    def change_input(self, t, u):
+        return 2*u
+
+    def change_state(self, x):
+        self.state = x
+
+    def derivative(self, e):
+        return 0
+
+
+def test_compiled_matches_interpreted():
+    ts = numpy.linspace(0, 50, 501)
+    diagram = delayed_loop()
+
+    interpreted = diagram.simulate(ts)
+    compiled = diagram.simulate(ts, compiled=True)
+
+    assert list(compiled) == list(interpreted)
+    for signal in interpreted:
+        assert compiled[signal] == pytest.approx(interpreted[signal])
+
+
+def test_ensemble_matches_individual_simulations():
+    ts = numpy.linspace(0, 50, 501)
+
+    def factory(Kc, tau_i, K):
+        return blocksim.simple_control_diagram(blocksim.PI('Gc', 'e', 'u', Kc, tau_i),
+                                               blocksim.LTI('G', 'u', 'yu', K, [10, 1], 1))
+
+    parameters = {'Kc': [0.5, 1, 2], 'tau_i': [10, 5, 20], 'K': [1, 2, 0.5]}
+    results = blocksim.Ensemble(factory, parameters).simulate(ts)
+
+    assert results['y'].shape == (3, len(ts))
+    for i in range(3):
+        single = factory(**{name: values[i] for name, values in parameters.items()}).simulate(ts)
+        for signal in single:
+            assert results[signal][i] == pytest.approx(single[signal])
+
+
+@pytest.mark.parametrize('compiled', [False, True])
+def test_record_and_decimate(compiled):
+    ts = numpy.linspace(0, 50, 501)
+    diagram = delayed_loop()
+
+    full = diagram.simulate(ts, compiled=compiled)
+    partial = diagram.simulate(ts, compiled=compiled, record=['y', 'u'], decimate=10)
+
+    assert list(partial) == ['y', 'u']
+    assert partial.t == pytest.approx(ts[::10])
+    assert partial['y'] == pytest.approx(full['y'][::10])
+    assert partial['u'].base is partial.data
+
+    with pytest.raises(ValueError):
+        diagram.simulate(ts, record=['nonexistent'])
+
+
+def test_deadtime_bounded_history():
+    ts = numpy.linspace(0, 100, 3001)
+    us = numpy.sin(ts) + numpy.cos(3.3*ts)
+    delay = blocksim.Deadtime('Delay', 'u', 'y', 2.3)
+
+    ys = [delay.change_input(t, u) for t, u in zip(ts, us)]
+
+    expected = numpy.interp(ts - 2.3, numpy.r_[0, ts], numpy.r_[0, us])
+    assert ys == pytest.approx(expected)
+    assert len(delay.ts) < 2*(2.3/ts[1] + 2)
+
+    undelayed = blocksim.Deadtime('Delay', 'u', 'y', 0)
+    ys = [undelayed.change_input(t, u) for t, u in zip(ts, us)]
+    assert ys == pytest.approx(us)
+    assert len(undelayed.ts) == 16
+
+
+@pytest.mark.parametrize('compiled', [False, True])
+def test_zoh_exact_for_large_timestep(compiled):
+    K, tau = 2, 0.5
+    ts = numpy.arange(0, 5, 1.0)
+    diagram = blocksim.Diagram([blocksim.LTI('G', 'u', 'y', K, [tau, 1])], {}, {'u': blocksim.step()})
+
+    result = diagram.simulate(ts, compiled=compiled, method='zoh')
+
+    expected = K*(1 - numpy.exp(-ts/tau))
+    assert result['y'] == pytest.approx(expected)
+
+
+@pytest.mark.parametrize('denominator', [[10, 1], [15, 8, 1]])
+def test_scalar_realisations_match_general(denominator):
+    Gss = blocksim.LTI('G', 'u', 'y', [3, 1], denominator).Gss
+    fast = blocksim.state_space(Gss.A, Gss.B, Gss.C, Gss.D)
+    general = blocksim.StateSpace(Gss.A, Gss.B, Gss.C, Gss.D)
+    assert type(fast) is not blocksim.StateSpace
+
+    for step in ['euler', 'integrate']:
+        for u in [1, 0.5, -2, 0]:
+            assert fast.output(u) == pytest.approx(general.output(u))
+            getattr(fast, step)(u, 0.3)
+            getattr(general, step)(u, 0.3)
+            assert fast.get_state() == pytest.approx(general.get_state())
+
+
+def test_blocks_are_slotted():
+    for block in [blocksim.PI('Gc', 'e', 'u', 1, 10), blocksim.PID('Gc', 'e', 'u', 1, 10),
+                  blocksim.Deadtime('D', 'u', 'y', 1), blocksim.Zero('Z', 'u', 'y')]:
+        assert not hasattr(block, '__dict__')
+    assert blocksim.PID('Gc', 'e', 'u', 1, 10).G.den == pytest.approx([1, 0])
+
+
+@pytest.mark.parametrize('compiled', [False, True])
+def test_discrete_samples_on_integer_ticks(compiled):
+    ts = numpy.linspace(0, 30, 301)
+    hold = blocksim.DiscreteTF('H', 'u', 'y', 0.3, [1], [1])
+    diagram = blocksim.Diagram([hold], {}, {'u': lambda t: t})
+
+    result = diagram.simulate(ts, compiled=compiled)
+
+    assert result['y'] == pytest.approx(ts[numpy.arange(len(ts))//3*3])
+    assert hold.tick == 101
+
+
+@pytest.mark.parametrize('method', ['euler', 'zoh'])
+def test_closed_form_between_samples(method, monkeypatch):
+    monkeypatch.setattr(blocksim, 'CHUNK_SIZE', 64)
+    ts = numpy.linspace(0, 60, 601)
+
+    def diagram():
+        Gc = blocksim.DiscreteTF('Gc', 'e', 'u', 1, [0.5, -0.4], [1, -1])
+        return blocksim.simple_control_diagram(Gc, blocksim.LTI('G', 'u', 'yu', 1, [15, 8, 1]),
+                                               blocksim.LTI('Gd', 'd', 'yd', 1, [3, 1]),
+                                               ysp=blocksim.step(starttime=5), d=blocksim.step(starttime=32))
+
+    sampled = diagram()
+    assert not sampled.linear() and sampled.linear(sampled=True)
+    expected = diagram().simulate(ts, method=method, closed_form=False)
+    result = sampled.simulate(ts, method=method, record=['y', 'u'], decimate=3)
+    for name in result:
+        assert result[name] == pytest.approx(expected[name][::3], abs=1e-10)
+    assert sampled.blocks[0].tick == 61
+    assert sampled.signals['y'] == pytest.approx(expected['y'][-1], abs=1e-10)
+
+
+@pytest.mark.parametrize('compiled', [False, True])
+def test_mimo_matches_siso_blocks(compiled):
+    # Wood-Berry column under decentralised PI control
+    numerators = [[12.8, -18.9], [6.6, -19.4]]
+    denominators = [[[16.7, 1], [21, 1]], [[10.9, 1], [14.4, 1]]]
+    delays = [[1, 3], [7, 3]]
+    ts = numpy.linspace(0, 100, 1001)
+
+    G = blocksim.MIMO.from_transfer_matrix('G', 'u', 'y', numerators, denominators, delays)
+    Kc = numpy.diag([0.2, -0.05])
+    Gc = blocksim.MIMO('Gc', 'e', 'u', numpy.zeros((2, 2)), numpy.eye(2), Kc/[4.4, 21], Kc)
+    ysp = numpy.array([1.0, 0.0])
+    diagram = blocksim.Diagram([G, Gc], {'e': ('+ysp', '-y')}, {'ysp': lambda t: ysp})
+    result = diagram.simulate(ts, compiled=compiled)
+
+    blocks = [blocksim.LTI(f'G{i}{j}', f'u{j}', f'y{i}{j}', numerators[i][j], denominators[i][j], delays[i][j])
+              for i in range(2) for j in range(2)]
+    blocks += [blocksim.PI('Gc0', 'e0', 'u0', 0.2, 4.4), blocksim.PI('Gc1', 'e1', 'u1', -0.05, 21)]
+    sums = {'y0': ('+y00', '+y01'), 'y1': ('+y10', '+y11'), 'e0': ('+ysp0', '-y0'), 'e1': ('+ysp1', '-y1')}
+    siso = blocksim.Diagram(blocks, sums, {'ysp0': blocksim.step(0, 0), 'ysp1': blocksim.zero}).simulate(ts)
+
+    assert diagram.sizes == {'u': 2, 'y': 2, 'e': 2, 'ysp': 2}
+    assert result['y'].shape == (2, len(ts))
+    for i in range(2):
+        assert result['y'][i] == pytest.approx(siso[f'y{i}'])
+        assert result['u'][i] == pytest.approx(siso[f'u{i}'])
+
+
+@pytest.mark.parametrize('compiled', [False, True])
+def test_profile(compiled):
+    ts = numpy.linspace(0, 50, 501)
+    diagram = delayed_loop()
+    plain = diagram.simulate(ts, compiled=compiled)
+    assert diagram.profile is None
+
+    result = diagram.simulate(ts, compiled=compiled, profile='memory')
+
+    for signal in plain:
+        assert result[signal] == pytest.approx(plain[signal])
+    entries = {(entry['kind'], entry['name']): entry for entry in diagram.profile.as_dict()['entries']}
+    assert entries['block', 'Limiter']['calls'] == len(ts)
+    assert entries['input', 'ysp']['allocated'] >= 0
+    if not compiled:
+        assert entries['sum', 'e']['calls'] == len(ts)
+    assert 'Limiter' in diagram.profile.report()
+
+
+@pytest.mark.parametrize('method', ['euler', 'zoh'])
+def test_closed_form_matches_stepping(method, monkeypatch):
+    ts = numpy.linspace(0, 50, 501)
+    # Identical tanks give repeated poles
+    blocks = [blocksim.LTI(f'G{i}', f'h{i}', f'h{i + 1}', 1, [2, 1]) for i in range(4)]
+    blocks += [blocksim.PID('Gc', 'e', 'h0', 0.5, 8, 1), blocksim.LTI('Gd', 'd', 'yd', 1, [3, 1])]
+    diagram = blocksim.Diagram(blocks, {'e': ('+ysp', '-y'), 'y': ('+h4', '+yd')},
+                               {'ysp': blocksim.step(), 'd': blocksim.step(starttime=25)})
+    assert diagram.linear()
+
+    stepped = blocksim.CompiledDiagram(diagram, ts[1], method)
+    expected = numpy.array([stepped.advance(t).copy() for t in ts]).T
+    diagram.reset()
+    solved = blocksim.CompiledDiagram(diagram, ts[1], method)
+    assert solved.linear
+    assert solved.solve(ts) == pytest.approx(expected, abs=1e-12)
+    assert solved.z == pytest.approx(stepped.z)
+
+    result = diagram.simulate(ts, method=method)
+    assert result['y'] == pytest.approx(expected[stepped.index['y']])
+
+    # Long simulations are solved in blocks, keeping only the recorded signals
+    monkeypatch.setattr(blocksim, 'CHUNK_SIZE', 64)
+    result = diagram.simulate(ts, method=method, record=['y'], decimate=3)
+    assert result.names == ['y']
+    assert result['y'] == pytest.approx(expected[stepped.index['y'], ::3], abs=1e-12)
+    assert diagram.signals['y'] == pytest.approx(expected[stepped.index['y'], -1], abs=1e-12)
+
+    stepped_result = diagram.simulate(ts, method=method, closed_form=False)
+    assert stepped_result['y'] == pytest.approx(expected[stepped.index['y']], abs=1e-12)
+
+
+@pytest.mark.parametrize('signal', [blocksim.step(1, 3, 2), blocksim.Ramp(0.1, 5),
+                                    blocksim.PulseTrain(10, 3, starttime=2), blocksim.PRBS(2, order=4),
+                                    blocksim.PiecewiseLinear([0, 10, 30], [0, 1, -1])])
+@pytest.mark.parametrize('compiled', [False, True])
+def test_input_signals_are_tabulated(signal, compiled, monkeypatch):
+    ts = numpy.linspace(0, 50, 501)
+    assert signal(ts) == pytest.approx([signal(t) for t in ts])
+
+    def diagram(ysp):
+        return blocksim.simple_control_diagram(blocksim.PI('Gc', 'e', 'u', 1, 10),
+                                               blocksim.LTI('G', 'u', 'yu', 1, [10, 1], 2), ysp=ysp)
+
+    expected = diagram(lambda t: signal(t)).simulate(ts, compiled=compiled)
+    result = diagram(signal).simulate(ts, compiled=compiled)
+    assert result['y'] == pytest.approx(expected['y'])
+
+    # Long simulations tabulate the inputs in blocks of times
+    monkeypatch.setattr(blocksim, 'CHUNK_SIZE', 64)
+    result = diagram(signal).simulate(ts, compiled=compiled)
+    assert result['y'] == pytest.approx(expected['y'])
+
+
+def test_prbs_has_maximum_length():
+    signal = blocksim.PRBS(1, order=5)
+    values = signal(numpy.arange(31.))
+    assert len(signal.sequence) == 31
+    assert (values == 1).sum() == 16
+    assert signal(31.) == values[0]
+
+
+@pytest.mark.parametrize('method', ['euler', 'zoh'])
+def test_generated_matches_interpreted(method):
+    ts = numpy.linspace(0, 50, 501)
+
+    def diagram(Kc):
+        Gc = blocksim.DiscreteTF('Gc', 'e', 'u', 1, [0.5*Kc, -0.4*Kc], [1, -1])
+        return blocksim.simple_control_diagram(Gc, blocksim.LTI('G', 'u', 'yu', 1, [15, 8, 1], 1),
+                                               blocksim.LTI('Gd', 'd', 'yd', 1, [3, 1]),
+                                               d=blocksim.step(starttime=25))
+
+    expected = diagram(1).simulate(ts, method=method)
+    result = diagram(1).simulate(ts, method=method, compiled='generated')
+    for name in expected:
+        assert result[name] == pytest.approx(expected[name], abs=1e-12)
+
+    # Diagrams with the same structure share the generated code
+    blocksim.compile_generated.cache_clear()
+    assert diagram(1).compile(ts[1], method).key == diagram(2).compile(ts[1], method).key
+    info = blocksim.compile_generated.cache_info()
+    assert (info.hits, info.misses) == (1, 1)
+
+
+def test_realisations_are_cached():
+    blocksim.lti_matrices.cache_clear()
+    G1 = blocksim.LTI('G1', 'u', 'y', 2, [10, 3, 3, 1])
+    G2 = blocksim.LTI('G2', 'u', 'y', [0, 4], [20, 6, 6, 2])
+    info = blocksim.lti_matrices.cache_info()
+    assert (info.hits, info.misses) == (1, 1)
+    assert G1.realisation.A is G2.realisation.A
+    assert not G1.realisation.A.flags.writeable
+    blocksim.lti_matrices.cache_clear()
+    assert blocksim.lti_matrices.cache_info().currsize == 0
+
+
+@pytest.mark.parametrize('compiled', [False, True])
+def test_initialise_steady_state(compiled):
+    ts = numpy.linspace(0, 50, 501)
+    blocks = [blocksim.PI('Gc', 'e', 'u', 1, 10),
+              blocksim.AlgebraicEquation('valve', 'u', 'q', lambda t, u: u**2),
+              blocksim.LTI('G', 'q', 'yu', 2, [10, 1], 2),
+              blocksim.LTI('Gd', 'd', 'yd', 1, [3, 1])]
+    diagram = blocksim.Diagram(blocks, {'e': ('+ysp', '-y'), 'y': ('+yu', '+yd')},
+                               {'ysp': blocksim.Constant(1), 'd': blocksim.Constant(0.5)})
+    initial = diagram.initialise_steady_state()
+    assert diagram.signals['y'] == pytest.approx(1)
+    assert diagram.signals['q'] == pytest.approx(0.25)
+    assert diagram.signals['u'] == pytest.approx(0.5)
+
+    result = diagram.simulate(ts, compiled=compiled, initial=initial)
+    for name in result:
+        assert result[name] == pytest.approx(result[name][0], abs=1e-10)
+
+    integrator = blocksim.Diagram([blocksim.LTI('G', 'u', 'y', 1, [1, 0])], {}, {'u': blocksim.Constant(1)})
+    with pytest.raises(ValueError):
+        integrator.initialise_steady_state()
+
+    custom = blocksim.Diagram([Gain('K', 'u', 'y')], {}, {'u': blocksim.Constant(1)})
+    with pytest.raises(ValueError, match="block 'K'"):
+        custom.initialise_steady_state()
+
+
+@pytest.mark.parametrize('method', ['euler', 'zoh'])
+def test_sparse_compiled_diagram(monkeypatch, method):
+    monkeypatch.setattr(blocksim, 'SPARSE_SIZE', 8)
+    ts = numpy.linspace(0, 30, 301)
+
+    def tanks():
+        blocks = []
+        for i in range(20):
+            blocks.append(blocksim.LTI(f'G{i}', f'h{i}', f'q{i}', 1, [1, 1]))
+            blocks.append(blocksim.Deadtime(f'D{i}', f'q{i}', f'h{i + 1}', 0.5))
+        return blocksim.Diagram(blocks, {}, {'h0': blocksim.step()})
+
+    engine = blocksim.CompiledDiagram(tanks(), ts[1], method)
+    assert all(isinstance(Phi, blocksim.RowUpdate) for Phi, callouts in engine.segments)
+    assert any(scipy.sparse.issparse(Phi.matrix) for Phi, callouts in engine.segments)
+
+    expected = tanks().simulate(ts, method=method)
+    result = tanks().simulate(ts, method=method, compiled=True)
+    assert result['h20'] == pytest.approx(expected['h20'], abs=1e-12)
+
+    # The derivative matrices follow the same rule as the rows
+    dPhi = numpy.zeros((2, 40, 40))
+    dPhi[:, 3, 4] = 1
+    assert scipy.sparse.issparse(blocksim.CompiledDiagram.derivative_matrix(dPhi))
+    assert not scipy.sparse.issparse(blocksim.CompiledDiagram.derivative_matrix(dPhi + 1))
+
+
+def test_delays_share_segments():
+    ts = numpy.linspace(0, 30, 301)
+
+    def tanks():
+        blocks = []
+        for i in range(60):
+            blocks.append(blocksim.LTI(f'G{i}', f'h{i}', f'q{i}', 1, [1, 1]))
+            blocks.append(blocksim.Deadtime(f'D{i}', f'q{i}', f'h{i + 1}', 0.5))
+        return blocksim.Diagram(blocks, {}, {'h0': blocksim.step()})
+
+    # The outputs of the tanks are calculated together before all the Deadtime
+    # blocks, followed by the integration, and each segment only stores the
+    # rows it changes
+    engine = blocksim.CompiledDiagram(tanks(), ts[1])
+    assert [len(callouts) for Phi, callouts in engine.segments] == [60, 0]
+    assert all(isinstance(Phi, blocksim.RowUpdate) for Phi, callouts in engine.segments)
+    assert sum(len(Phi.rows) for Phi, callouts in engine.segments) == 120
+
+    expected = tanks().simulate(ts)
+    result = tanks().simulate(ts, compiled=True)
+    assert result['h60'] == pytest.approx(expected['h60'], abs=1e-12)
+
+
+# Without a delay the loop is linear, so it is solved in closed form
+@pytest.mark.parametrize('compiled, delay', [(False, 2), (True, 2), ('generated', 2), (False, 0)])
+def test_metrics_accumulated(compiled, delay, monkeypatch):
+    # The metrics are accumulated over several blocks of times
+    monkeypatch.setattr(blocksim, 'CHUNK_SIZE', 64)
+    ts = numpy.linspace(0, 50, 501)
+    metrics = dict(blocksim.DEFAULT_METRICS, ISE=blocksim.ISE(), max=blocksim.MaxDeviation())
+    diagram = blocksim.simple_control_diagram(blocksim.PI('Gc', 'e', 'u', 1, 10),
+                                              blocksim.LTI('G', 'u', 'yu', 1, [10, 1], delay))
+    full = diagram.simulate(ts, closed_form=False)
+    diagram.reset()
+    result = diagram.simulate(ts, record=[], metrics=metrics, compiled=compiled)
+
+    assert result.data.shape == (0, len(ts))
+    for name, metric in metrics.items():
+        assert type(result.metrics[name]) is float
+        assert result.metrics[name] == pytest.approx(metric(full), abs=1e-10)
+
+
+def test_metrics_extended_in_blocks():
+    ts = numpy.linspace(0, 50, 501)
+    r = numpy.where(ts < 3, 1.0, 0.5)
+    y = r + 0.5*numpy.exp(-ts/5)*numpy.cos(ts)
+    metrics = [blocksim.IAE(), blocksim.ITAE(), blocksim.ISE(), blocksim.MaxDeviation(),
+               blocksim.Overshoot(), blocksim.SettlingTime(), blocksim.SettlingTime(tolerance=0.7)]
+    for metric in metrics:
+        values = [r - y] if len(metric.signals) == 1 else [y, r]
+        stepped = metric.start()
+        for t, *row in zip(ts, *values):
+            metric.update(stepped, t, *row)
+        extended = metric.start()
+        for start, stop in [(0, 1), (1, 300), (300, 300), (300, 301), (301, 501)]:
+            metric.extend(extended, ts[start:stop], *[v[start:stop] for v in values])
+        assert type(metric.finish(stepped)) is float
+        assert metric.finish(extended) == pytest.approx(metric.finish(stepped), abs=1e-12)
+
+
+@pytest.mark.filterwarnings('error')
+def test_metrics_without_setpoint_change():
+    ts = numpy.linspace(0, 50, 501)
+    diagram = blocksim.simple_control_diagram(blocksim.PI('Gc', 'e', 'u', 1, 10),
+                                              blocksim.LTI('G', 'u', 'yu', 1, [10, 1], 2),
+                                              Gd=blocksim.LTI('Gd', 'd', 'yd', 1, [5, 1]),
+                                              ysp=blocksim.zero, d=blocksim.step(starttime=5))
+    metrics = {'overshoot': blocksim.Overshoot(), 'settling_time': blocksim.SettlingTime()}
+    result = diagram.simulate(ts, metrics=metrics)
+    assert result.metrics == {'overshoot': 0, 'settling_time': 0}
+    for name, metric in metrics.items():
+        assert metric(result) == result.metrics[name]
+    assert blocksim.Overshoot().gradient(result, [result]) == pytest.approx([0])
+
+
+@pytest.mark.parametrize('method', ['euler', 'zoh'])
+def test_sensitivities_match_finite_differences(method, monkeypatch):
+    # The inputs are tabulated in several blocks of times
+    monkeypatch.setattr(blocksim, 'CHUNK_SIZE', 64)
+    ts = numpy.linspace(0, 60, 601)
+    parameters = {'Kc': 2, 'tau_i': 8, 'tau_d': 1.5}
+    metrics = {'IAE': blocksim.IAE(), 'ISE': blocksim.ISE(), 'overshoot': blocksim.Overshoot()}
+
+    def loop(**changes):
+        Gc = blocksim.PID('Gc', 'e', 'u', **dict(parameters, **changes))
+        return blocksim.simple_control_diagram(Gc, blocksim.LTI('G', 'u', 'yu', 1, [10, 1], 2))
+
+    result = loop().simulate_sensitivity(ts, [('Gc', name) for name in parameters], metrics, method=method)
+    assert result['y'] == pytest.approx(loop().simulate(ts, compiled=True, method=method)['y'], abs=1e-12)
+    h = 1e-6
+    for k, (name, value) in enumerate(parameters.items()):
+        up = loop(**{name: value + h}).simulate(ts, compiled=True, method=method)
+        down = loop(**{name: value - h}).simulate(ts, compiled=True, method=method)
+        assert result.sensitivities['Gc', name]['y'] == pytest.approx((up['y'] - down['y'])/(2*h), abs=1e-7)
+        for metric_name, metric in metrics.items():
+            expected = (metric(up) - metric(down))/(2*h)
+            assert result.gradients[metric_name][k] == pytest.approx(expected, rel=1e-6, abs=1e-7)
+
+
+def test_stored_result(tmp_path):
+    ts = numpy.linspace(0, 20, 201)
+    diagram = blocksim.simple_control_diagram(blocksim.PI('Gc', 'e', 'u', 1, 10),
+                                              blocksim.LTI('G', 'u', 'yu', 1, [10, 1], 2))
+    expected = diagram.simulate(ts)
+    diagram.reset()
+    diagram.simulate(ts, store=tmp_path / 'run')
+
+    result = blocksim.SimulationResult.open(tmp_path / 'run')
+    assert isinstance(result.data, numpy.memmap)
+    assert result.names == expected.names
+    assert result.t == pytest.approx(ts)
+    assert result['y'] == pytest.approx(expected['y'])
+
+
+def test_adaptive_fopdt_step():
+    K, tau, theta = 2, 5, 3
+    ts = numpy.linspace(0, 40, 401)
+    diagram = blocksim.Diagram([blocksim.LTI('G', 'u', 'y', K, [tau, 1], theta)], {},
+                               {'u': blocksim.step(starttime=1)})
+
+    result = diagram.simulate(ts, method='adaptive')
+
+    expected = K*(1 - numpy.exp(-(ts - theta - 1).clip(0)/tau))
+    assert result['y'] == pytest.approx(expected, abs=1e-5)
+
+
+def test_adaptive_matches_fine_fixed_step():
+    diagram = delayed_loop()
+
+    adaptive = diagram.simulate(numpy.linspace(0, 50, 101), method='adaptive')
+    fine = diagram.simulate(numpy.linspace(0, 50, 20001), compiled=True, method='zoh')
+
+    for signal in ['y', 'u', 'ulimited']:
+        assert adaptive[signal][1:] == pytest.approx(fine[signal][::200][1:], abs=1e-2)
+
+
+def test_adaptive_rejects_custom_blocks():
+    diagram = blocksim.Diagram([Gain('K', 'u', 'y')], {}, {'u': blocksim.step()})
+
+    with pytest.raises(ValueError, match="block 'K'"):
+        diagram.simulate(numpy.linspace(0, 1, 11), method='adaptive')
+
+
+def test_algebraic_loop_detected():
+    G = blocksim.LTI('G', 'e', 'y', 2)
+
+    with pytest.raises(ValueError, match='Algebraic loop'):
+        blocksim.Diagram([G], {'e': ('+ysp', '-y')}, {'ysp': blocksim.step()})
+
+
+def test_results_independent_of_block_order():
+    ts = numpy.linspace(0, 50, 501)
+    diagram = delayed_loop()
+    result = diagram.simulate(ts)
+
+    diagram.blocks.reverse()
+    reversed_result = diagram.simulate(ts)
+
+    for signal in result:
+        assert reversed_result[signal] == pytest.approx(result[signal])
+
+
+@pytest.mark.parametrize('compiled', [False, True])
+def test_states_integrated_with_current_inputs(compiled):
+    # G has no feedthrough, so it is evaluated before the sum which gives its input
+    G = blocksim.LTI('G', 'e', 'y', 1, [1, 1])
+    diagram = blocksim.Diagram([G], {'e': ('+ysp',)}, {'ysp': blocksim.step()})
+    ts = numpy.linspace(0, 2, 21)
+
+    result = diagram.simulate(ts, compiled=compiled)
+
+    assert result['y'] == pytest.approx(1 - 0.9**numpy.arange(len(ts)))
+
+
+def test_unknown_signal_in_sum():
+    G = blocksim.LTI('G', 'e', 'y', 1, [1, 1])
+
+    with pytest.raises(ValueError, match="no signal called 'r'"):
+        blocksim.Diagram([G], {'e': ('+r', '-y')}, {'ysp': blocksim.step()})
+
+
+def sweep_factory(Kc, tau_i):
+    return blocksim.simple_control_diagram(blocksim.PI('Gc', 'e', 'u', Kc, tau_i),
+                                           blocksim.LTI('G', 'u', 'yu', 1, [10, 1], 1))
+
+
+def failing_factory(Kc, tau_i):
+    raise AssertionError("Finished points should not be simulated again")
+
+
+def test_sweep_resume(tmp_path):
+    ts = numpy.linspace(0, 50, 501)
+    grid = {'Kc': [1, 2], 'tau_i': [5, 10, 20]}
+    filename = tmp_path / 'sweep.jsonl'
+
+    results = blocksim.sweep(sweep_factory, grid, ts, workers=2, resume=filename)
+
+    assert len(results) == 6
+    assert results[1]['Kc'] == 1 and results[1]['tau_i'] == 10
+    single = sweep_factory(1, 10).simulate(ts)
+    assert results[1]['IAE'] == pytest.approx(blocksim.IAE()(single))
+
+    resumed = blocksim.sweep(failing_factory, grid, ts, workers=1, resume=filename)
+    assert resumed == results
+
+    # Only the points of another grid which are in the file are taken from it
+    other = blocksim.sweep(sweep_factory, {'Kc': [2, 3], 'tau_i': [10]}, ts, workers=1, resume=filename)
+    assert other[0] == results[4]
+    single = sweep_factory(3, 10).simulate(ts)
+    assert other[1]['IAE'] == pytest.approx(blocksim.IAE()(single))
+
+
+def test_iter_simulate_chunks():
+    dt = 0.1
+    diagram = delayed_loop()
+    full = diagram.simulate(numpy.arange(0, 501)*dt)
+
+    chunks = list(diagram.iter_simulate(50, dt, chunk=64, record=['y']))
+
+    assert [len(c.t) for c in chunks[:-1]] == [64]*(len(chunks) - 1)
+    assert numpy.concatenate([c['y'] for c in chunks]) == pytest.approx(full['y'])
+
+    chunks = list(diagram.iter_simulate(50, dt, chunk=64, stop=lambda chunk: chunk['y'] > 0.5))
+    assert chunks[-1]['y'][-1] > 0.5
+    assert all(chunk['y'][:-1].max() <= 0.5 for chunk in chunks)
+
+
+@pytest.mark.parametrize('compiled', [False, True])
+def test_snapshot_branching(compiled):
+    dt = 0.1
+    ts = numpy.arange(0, 601)*dt
+    G = blocksim.LTI('G', 'u', 'yu', 1, [15, 8, 1], 1)
+    Gc = blocksim.DiscreteTF('Gc', 'e', 'u', 1, [0.5, -0.4], [1, -1])
+    diagram = blocksim.simple_control_diagram(Gc, G, ysp=blocksim.step(starttime=5))
+    full = diagram.simulate(ts, compiled=compiled)
+
+    diagram.simulate(ts[:300], compiled=compiled)
+    warm = diagram.snapshot()
+    assert warm['time'] == pytest.approx(ts[300])
+
+    for _ in range(2):
+        branch = diagram.simulate(ts[300:], compiled=compiled, initial=warm)
+        for signal in full:
+            assert branch[signal] == pytest.approx(full[signal][300:])
+
+
+def test_block_state_assignment_and_snapshot():
+    G = blocksim.LTI('G', 'u', 'y', 1, [15, 8, 1])
+    G.x = [1, 2]
+    assert G.x.ravel() == pytest.approx([1, 2])
+    G.state = numpy.array([[3], [4]])
+    assert G.state.ravel() == pytest.approx([3, 4])
+
+    class Slotted(blocksim.Block):
+        __slots__ = ('state',)
+        reset = Gain.reset
+        change_state = Gain.change_state
+
+    block = Slotted('K', 'u', 'y')
+    assert not hasattr(block, '__dict__')
+    block.reset()
+    block.change_state(2)
+    snapshot = block.snapshot()
+    block.change_state(5)
+    block.restore(snapshot)
+    assert block.state == 2
+
+
+def test_realtime_runner_with_model_plant():
+    class Clock:
+        now = 0.0
+
+        def __call__(self):
+            return self.now
+
+        async def sleep(self, seconds):
+            self.now += seconds
+
+    class Plant:
+        # First order plant integrated by the "hardware"
+        y = 0.0
+
+        def write(self, u):
+            clock.now += 0.01  # time taken to write
+            self.y += 0.1*(2*u - self.y)
+
+    clock = Clock()
+    plant = Plant()
+    Gc = blocksim.PI('Gc', 'e', 'u', 0.5, 2)
+    diagram = blocksim.Diagram([Gc], {'e': ('+ysp', '-y')}, {'ysp': blocksim.step(), 'y': blocksim.zero})
+    runner = realtime.RealTimeRunner(diagram, 0.1, sources={'y': lambda: plant.y}, sinks={'u': plant.write},
+                                     clock=clock, sleep=clock.sleep)
+
+    result = asyncio.run(runner.run(30))
+
+    assert len(result.t) == 301
+    assert result['y'][-1] == pytest.approx(1, abs=0.02)
+    assert runner.latency == pytest.approx(0.01)
+    assert runner.timing()['deadline_misses'] == 0
+    assert diagram.inputs['y'] is blocksim.zero
+
+
+def test_realtime_runner_callbacks():
+    diagram = blocksim.Diagram([blocksim.PI('Gc', 'e', 'u', 0.5, 2)], {'e': ('+ysp', '-y')},
+                               {'ysp': blocksim.step(), 'y': blocksim.zero})
+    with pytest.raises(ValueError, match="sink signal 'v'"):
+        realtime.RealTimeRunner(diagram, 0.1, sinks={'v': print})
+    with pytest.raises(ValueError, match="source signal 'u'"):
+        realtime.RealTimeRunner(diagram, 0.1, sources={'u': lambda: 0})
+
+    written = []
+
+    async def write(u):
+        written.append(u)
+
+    async def sleep(seconds):
+        pass
+
+    runner = realtime.RealTimeRunner(diagram, 0.1, sources={'y': lambda: 0.5}, sinks={'u': write},
+                                     sleep=sleep)
+    assert runner.timing()['steps'] == 0
+    result = asyncio.run(runner.run(1))
+    assert written == pytest.approx(result['u'])
+    assert result['e'] == pytest.approx(0.5)